@@ -1,37 +1,75 @@
 # -*- coding: utf-8 -*-
 
-from uiComponents import *
-from clientLogic import *
-from calendarLogic import *
-from utils import *
+import os, sys, threading
 
 # TODO: change to AutoBiller.* for distribution
+# Until then the modules import each other by name, so when this is run as
+# the installed package (the AutoBiller command), its folder must be on the path.
+PACKAGE_PATH = os.path.dirname(os.path.abspath(__file__))
+if PACKAGE_PATH not in sys.path:
+    sys.path.insert(0, PACKAGE_PATH)
+
+def preload():
+    """Import everything the main scene needs, while the user is logging in"""
+    import pyicloud
+    import uiComponents
+
+def show_main_scene(login_window, icloud, username, session):
+    """Build the main scene for the logged in account, and swap it in for the login window"""
+    from uiComponents import MainScene
+    from clientLogic import ClientDirectory, ClientEventIndex
+    from calendarLogic import CalendarManager
+
+    calendar_manager = CalendarManager()
+    client_directory = ClientDirectory()
+    calendar_manager.use_client_index(ClientEventIndex(client_directory))
+    main_scene = MainScene(client_directory, calendar_manager)
+    calendar_manager.parent = main_scene
+    main_scene.set_account(icloud, username, session)
+
+    main_scene.go_to_main()
+    main_scene.show()
+    login_window.main_scene = main_scene
+    login_window.hide()
 
 def main():
+    if len(sys.argv) > 1:
+        # Command line mode never imports the GUI
+        from cli import main as cli_main
+        sys.exit(cli_main(sys.argv[1:]))
+
+    from PyQt5.QtWidgets import QApplication
+    from PyQt5.QtGui import QPalette, QColor
+    from loginComponents import LoginWindow
+    from instrumentation import metrics
+    from sessionStore import close_all_sessions
+    from utils import get_data_path
+
     autobiller = QApplication([])
 
+    # Log how long each stage takes, for diagnosing slow queries
+    metrics.use_log(os.environ.get("AUTOBILLER_METRICS_LOG") or os.path.join(get_data_path(), "metrics.jsonl"))
+    autobiller.aboutToQuit.connect(metrics.write_summary)
+    # Only the encrypted copy of each iCloud session is left behind
+    autobiller.aboutToQuit.connect(close_all_sessions)
+
     # Give the app a color palette
     palette = QPalette()
     palette.setColor(QPalette.Window, QColor("#FCF8E9"))
     palette.setColor(QPalette.Button, QColor("#FFFBF3"))
     autobiller.setPalette(palette)
 
-    # Init the main scene
-    calendar_manager = CalendarManager()
-    client_directory = ClientDirectory()
-    main_scene = MainScene(client_directory, calendar_manager)
-    calendar_manager.parent = main_scene
-
-    # Set opening scene and show
-    login_widget = LoginWidget(parent=main_scene)
-    main_scene.setCentralWidget(login_widget)
-    main_scene.show()
+    # Show the login window first, then load the rest in the background
+    login_window = LoginWindow(on_login=lambda icloud, username, session: show_main_scene(login_window, icloud, username, session))
+    login_window.show()
 
-    # main_scene.go_to_main()
-    # main_scene.toolbar.show()
-    # a = CalendarEvent({"title":"test", "duration":45, "localStartDate":[0, 2021, 2, 3, 12, 0]})
-    # b = CalendarEvent({"title":"test2", "duration":45, "localStartDate":[0, 2021, 2, 3, 12, 0]})
-    # d = main_scene.new_display_query_by_day_widget("TEST", [a,b])
+    if os.environ.get("AUTOBILLER_STARTUP_BENCHMARK"):
+        # Used by startupBenchmark: report that the first window is up, then quit
+        from PyQt5.QtCore import QTimer
+        QTimer.singleShot(0, lambda: (print("first window shown", flush=True), autobiller.quit()))
+    else:
+        threading.Thread(target=preload, daemon=True).start()
+        login_window.resume_session()
 
     autobiller.exec_()
 
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+import argparse, json, os, random, sys, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from calendarLogic import *
+from clientLogic import *
+from billingModel import *
+
+# Benchmarks of the calendar cache and the billing pipeline, run against a
+# SyntheticBackend so they need no iCloud account. Run from the AutoBiller folder:
+#     python benchmarks.py [--only NAME] [--save FILE] [--compare FILE]
+#
+# Each benchmark builds its input fresh (untimed), then times one run over it.
+# The best of REPEATS runs is reported, in "name value ms" lines. With
+# --compare, any benchmark more than TOLERANCE times (and NOISE_MS) slower
+# than its baseline fails the run. resources/benchmarks.json is the baseline to compare against.
+# The UI benchmarks paint offscreen, and are skipped if PyQt5 isn't installed.
+
+REPEATS = 7
+TOLERANCE = 1.3
+NOISE_MS = 2.0
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "benchmarks.json")
+
+START = datetime(2021, 1, 4)
+
+# The QApplication the UI benchmarks paint with, kept for the whole run
+_qt_app = []
+
+class Skipped(Exception):
+    """Raised by a benchmark that can't run here, e.g. without PyQt5"""
+
+def misspell(name, rng):
+    """name with two neighbouring letters swapped, like a hurried calendar entry"""
+    position = rng.randrange(1, len(name) - 2)
+    return name[:position] + name[position + 1] + name[position] + name[position + 2:]
+
+def new_manager(backend=None):
+    """A CalendarManager over synthetic data, prefetching in the foreground so runs are repeatable"""
+    manager = CalendarManager(backend=backend or SyntheticBackend(events_per_day=8))
+    manager.prefetcher = Prefetcher(manager, background=False)
+    return manager
+
+def new_directory(client_count, seed=0):
+    """A ClientDirectory of client_count synthetic clients"""
+    directory = ClientDirectory()
+    for name in synthetic_names(client_count, seed):
+        directory.add_client(name, "Aetna")
+    return directory
+
+def check_index(date_ranges):
+    """Make sure a DateRangeIndex is sorted, non-overlapping, and in date order inside"""
+    ranges = list(date_ranges)
+    for before, after in zip(ranges, ranges[1:]):
+        assert before.end + ONE_DAY < after.start, "date ranges overlap or touch: {}".format(ranges)
+    for dr in ranges:
+        columns = dr.columns
+        events, starts, titles = columns.events, columns.starts, columns.titles
+        # A DateRange is only ever replaced, never changed while it's in the index
+        assert len(events) == len(starts) == len(titles), "half-updated columns in {}".format(dr)
+        assert all(to_epoch(e.date) == start for e, start in zip(events, starts)), "columns disagree in {}".format(dr)
+        assert all(a.date <= b.date for a, b in zip(events, events[1:])), "events out of order in {}".format(dr)
+        assert all(dr.contains(e.day) for e in events), "event outside of {}".format(dr)
+
+# Each benchmark is a function that builds its input and returns the function to time
+
+def add_one_day_sequential():
+    manager = new_manager()
+    days = [START + timedelta(days=n) for n in range(90)]
+    def run():
+        for day in days:
+            manager.add_one_day(day)
+        check_index(manager.date_ranges)
+    return run
+
+def add_one_day_random():
+    manager = new_manager()
+    rng = random.Random(1)
+    days = [START + timedelta(days=rng.randrange(365)) for _ in range(300)]
+    def run():
+        for day in days:
+            manager.add_one_day(day)
+        check_index(manager.date_ranges)
+    return run
+
+def add_date_range_overlapping():
+    manager = new_manager()
+    rng = random.Random(2)
+    ranges = []
+    for _ in range(60):
+        start = START + timedelta(days=rng.randrange(365))
+        ranges.append(DateRange(start, start + timedelta(days=rng.randrange(1, 30))))
+    def run():
+        for dr in ranges:
+            events = manager.add_date_range(DateRange(dr.start, dr.end), record=False)
+            assert all(dr.contains(e.day) for e in events)
+        check_index(manager.date_ranges)
+    return run
+
+def concurrent_add_one_day():
+    """A stress test: hundreds of add_one_day calls at once, from many threads,
+       against a backend with some latency, while readers keep reading every
+       DateRange. Each day must come back with exactly its own events, and
+       no reader may ever see an index that's half merged."""
+    manager = new_manager(SyntheticBackend(events_per_day=8, latency=0.002, jitter=0.002))
+    reference = SyntheticBackend(events_per_day=8)
+    rng = random.Random(5)
+    days = [START + timedelta(days=rng.randrange(120)) for _ in range(400)]
+    def run():
+        errors = []
+        stop = threading.Event()
+
+        def query(day):
+            expected = [event["guid"] for event in reference.events_on(day)]
+            got = [event.identity() for event in manager.add_one_day(day)]
+            if got != expected:
+                errors.append("{}: got {} events, expected {}".format(day, len(got), len(expected)))
+
+        def read():
+            while not stop.is_set():
+                try:
+                    check_index(manager.date_ranges)
+                except Exception as error:
+                    errors.append("{}: {}".format(type(error).__name__, error))
+                # Leave the writers some of the GIL
+                time.sleep(0.001)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            list(pool.map(query, days))
+        stop.set()
+        for reader in readers:
+            reader.join()
+
+        check_index(manager.date_ranges)
+        assert not errors, errors[:5]
+    return run
+
+def all_events_within():
+    manager = new_manager()
+    manager.add_date_range(DateRange(START, START + timedelta(days=2 * 365)), record=False)
+    dr = manager.date_ranges[0]
+    rng = random.Random(3)
+    sub_ranges = []
+    for _ in range(10000):
+        start = START + timedelta(days=rng.randrange(2 * 365))
+        sub_ranges.append(DateRange(start, start + timedelta(days=rng.randrange(31))))
+    def run():
+        for sub_dr in sub_ranges:
+            dr.all_events_within(sub_dr)
+    return run
+
+def is_event_billable(client_count):
+    def benchmark():
+        # A fifth of the events are misspelled, so fuzzy matching is timed too
+        rng = random.Random(4)
+        names = synthetic_names(client_count)
+        titles = names + [misspell(name, rng) for name in names[:max(1, client_count // 4)]]
+        backend = SyntheticBackend(titles=titles, events_per_day=8, seed=client_count)
+        events = list(parse_events(backend.fetch_events(START, START + timedelta(days=2 * 365))))[:5000]
+        directory = new_directory(client_count)
+        def run():
+            for event in events:
+                directory.is_event_billable(event)
+        return run
+    return benchmark
+
+def billed_rows(count):
+    directory = new_directory(100)
+    backend = SyntheticBackend(titles=synthetic_names(100), events_per_day=8, other_rate=0)
+    events = list(parse_events(backend.fetch_events(START, START + timedelta(days=365))))[:count]
+    rows = [BillingRow(event) for event in events]
+    for row in rows:
+        session_data = directory.is_event_billable(row.event)
+        if session_data:
+            row.check(**session_data)
+    return rows
+
+def billing_table(count):
+    def benchmark():
+        # The table is painted offscreen, so this runs without a display
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        try:
+            from PyQt5.QtWidgets import QApplication, QTableView
+        except ImportError:
+            raise Skipped("PyQt5 isn't installed")
+        from uiComponents import BillingTableModel, DisplayQueryWidget
+
+        if not _qt_app:
+            _qt_app.append(QApplication.instance() or QApplication([]))
+        rows = billed_rows(count)
+        def run():
+            # What DisplayQueryWidget does with a finished report, then one paint
+            table = QTableView()
+            table.horizontalHeader().setResizeContentsPrecision(DisplayQueryWidget.SIZING_SAMPLE)
+            table.setModel(BillingTableModel(rows, BILLING_HEADER))
+            table.resize(900, DisplayQueryWidget.MAX_HEIGHT)
+            table.resizeColumnsToContents()
+            table.grab()
+        return run
+    return benchmark
+
+def export(export_format):
+    def benchmark():
+        rows = billed_rows(5000)
+        path = os.path.join(tempfile.mkdtemp(), "report." + EXPORT_EXTENSIONS[export_format])
+        def run():
+            export_rows(rows, RANGE_BILLING_HEADER[1:], path, export_format)
+        return run
+    return benchmark
+
+BENCHMARKS = [
+    ("calendar.add_one_day.sequential", add_one_day_sequential),
+    ("calendar.add_one_day.random", add_one_day_random),
+    ("calendar.add_date_range.overlapping", add_date_range_overlapping),
+    ("calendar.add_one_day.concurrent", concurrent_add_one_day),
+    ("calendar.all_events_within", all_events_within),
+    ("clients.is_event_billable.10", is_event_billable(10)),
+    ("clients.is_event_billable.100", is_event_billable(100)),
+    ("clients.is_event_billable.1000", is_event_billable(1000)),
+    ("ui.billing_table.5000", billing_table(5000)),
+    ("export.csv", export("csv")),
+    ("export.cms1500", export("cms1500")),
+]
+
+def time_benchmark(benchmark, repeats=REPEATS):
+    """The best time, in ms, of repeats runs, each on freshly built input"""
+    best = None
+    for _ in range(repeats):
+        run = benchmark()
+        start = time.perf_counter()
+        run()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(only=None, repeats=REPEATS):
+    results = {}
+    for name, benchmark in BENCHMARKS:
+        if only and only not in name:
+            continue
+        try:
+            results[name] = time_benchmark(benchmark, repeats)
+        except Skipped as reason:
+            print("{} skipped: {}".format(name, reason), flush=True)
+            continue
+        print("{} {:.1f} ms".format(name, results[name]), flush=True)
+    return results
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Print how each result moved against the baseline. Returns False on a regression."""
+    passed = True
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        ratio = value / baseline[name] if baseline[name] else 1.0
+        status = "ok"
+        if ratio > tolerance and value - baseline[name] > NOISE_MS:
+            status = "REGRESSION"
+            passed = False
+        print("{} {:.1f}ms vs {:.1f}ms baseline ({:+.0%}) {}".format(name, value, baseline[name], ratio - 1, status))
+    return passed
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the calendar cache and billing pipeline")
+    parser.add_argument("--only", help="Only run benchmarks whose name contains this")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--save", metavar="FILE", help="Save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", nargs="?", const=BASELINE,
+                        help="Fail if slower than a saved baseline (default: {})".format(BASELINE))
+    args = parser.parse_args(argv)
+
+    results = run(args.only, args.repeats)
+    if args.save:
+        with open(args.save, "w+") as f:
+            json.dump({name: round(value, 1) for name, value in results.items()}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(results, json.load(f)):
+                return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
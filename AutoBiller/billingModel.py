@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+from instrumentation import metrics
+from utils import get_fees, write_csv_file, write_xlsx_file, write_text_file
+
+CPT_CODES = ["90791", "96152", "90832", "90834", "90837", "90853", "90847", "90839"]
+DEFAULT_CPT = "90834"
+BILLING_HEADER = ["Billable?", "Event / Client", "CPT", "Insurance", "Payment", "Billing Fee"]
+RANGE_BILLING_HEADER = ["Billable?", "Date", "Event / Client", "CPT", "Insurance", "Payment", "Billing Fee"]
+PRACTICE_BILLING_HEADER = ["Billable?", "Date", "Clinician", "Event / Client", "CPT", "Insurance", "Payment", "Billing Fee"]
+GROUP_BY = ["day", "client", "clinician"]
+
+# The BillingRow attribute behind each column
+FIELD_BY_COLUMN = {
+    "Date": "date",
+    "Clinician": "clinician",
+    "Event / Client": "name",
+    "CPT": "cpt",
+    "Insurance": "insurance",
+    "Payment": "payment",
+    "Billing Fee": "fee",
+}
+EDITABLE_COLUMNS = ["Event / Client", "CPT", "Insurance", "Payment"]
+
+# The fixed-width record written for each session in a CMS-1500-style file:
+# (field, width, right aligned?)
+CMS1500_COLUMNS = [
+    ("Date of Service", 8, False),
+    ("Patient", 24, False),
+    ("CPT", 5, False),
+    ("Insurance", 20, False),
+    ("Charges", 9, True),
+    ("Paid", 9, True),
+]
+EXPORT_FORMATS = ["csv", "xlsx", "cms1500"]
+EXPORT_EXTENSIONS = {"csv": "csv", "xlsx": "xlsx", "cms1500": "txt"}
+
+class BillingRow(object):
+    """One event in a billing report, and how it's being billed.
+       An unchecked row just shows the event's title.
+       In a practice-wide report, clinician is whose calendar the event is from."""
+
+    def __init__(self, event, clinician=""):
+        super(BillingRow, self).__init__()
+        self.event = event
+        self.clinician = clinician
+        self.uncheck()
+
+    @property
+    def date(self):
+        return self.event.readable_date()
+
+    def check(self, name="Client", cpt=DEFAULT_CPT, insurance="", fee=None, client=None, confidence=1.0):
+        """Mark the row as billable, with the given session info"""
+        self.checked = True
+        self.client = client
+        self.name = name
+        self.insurance = insurance or ""
+        self.payment = ""
+        self.set_cpt(cpt or DEFAULT_CPT)
+        if fee:
+            self.fee = fee
+
+    def uncheck(self):
+        """Mark the row as not billable"""
+        self.checked = False
+        self.client = None
+        self.name = None
+        self.cpt = None
+        self.insurance = None
+        self.payment = None
+        self.fee = None
+
+    def set_cpt(self, cpt):
+        """Change the CPT code, and the fee along with it"""
+        self.cpt = cpt
+        self.fee = str(get_fees()[cpt])
+
+    def set_field(self, column, value):
+        """Edit the field shown in the named column"""
+        assert column in EDITABLE_COLUMNS
+        field = FIELD_BY_COLUMN[column]
+        if field == "cpt":
+            self.set_cpt(value)
+        else:
+            setattr(self, field, value)
+
+    def value(self, column):
+        """The text shown in the named column"""
+        field = FIELD_BY_COLUMN[column]
+        if field == "date":
+            return self.date
+        if field == "clinician":
+            return self.clinician
+        if not self.checked:
+            return self.event.title if field == "name" else "---"
+        return getattr(self, field)
+
+    def as_dict(self, fieldnames=BILLING_HEADER[1:]):
+        """The row's fields, keyed by column name"""
+        return {field: self.value(field) for field in fieldnames}
+
+def group_key(row, group_by):
+    """The group a row belongs to in a report grouped by "day", "client" or "clinician" """
+    if group_by == "client":
+        return row.name if row.checked else "Not billed"
+    if group_by == "clinician":
+        return row.clinician
+    return row.event.day.strftime("%m/%d/%Y")
+
+def sort_rows(rows, group_by):
+    """Sort rows by date, or by client or clinician and then date"""
+    if group_by == "client":
+        rows.sort(key=lambda row: (not row.checked, row.name or "", row.event.date))
+    elif group_by == "clinician":
+        rows.sort(key=lambda row: (row.clinician, row.event.date))
+    else:
+        rows.sort(key=lambda row: row.event.date)
+
+def billing_totals(rows, group_by):
+    """Returns an OrderedDict of group -> (number of billed sessions, total fee)
+       for the checked rows, plus a "Total" entry for all of them."""
+    totals = OrderedDict()
+    all_sessions, all_fees = 0, 0
+    for row in rows:
+        if not row.checked:
+            continue
+        fee = int(row.fee) if str(row.fee).isdigit() else 0
+        sessions, fees = totals.get(group_key(row, group_by), (0, 0))
+        totals[group_key(row, group_by)] = (sessions + 1, fees + fee)
+        all_sessions += 1
+        all_fees += fee
+    totals["Total"] = (all_sessions, all_fees)
+    return totals
+
+def checked_row_dicts(rows, fieldnames):
+    """A generator of the fields of every checked row"""
+    for row in rows:
+        if row.checked:
+            yield row.as_dict(fieldnames)
+
+def money(amount):
+    """Format a fee or payment as dollars and cents, or "" if it isn't a number"""
+    try:
+        return "{:.2f}".format(float(amount))
+    except (TypeError, ValueError):
+        return ""
+
+def cms1500_lines(rows):
+    """A generator of one fixed-width CMS-1500-style record per checked row"""
+    for row in rows:
+        if not row.checked:
+            continue
+        fields = {
+            "Date of Service": row.event.day.strftime("%m%d%Y"),
+            "Patient": row.name or "",
+            "CPT": row.cpt or "",
+            "Insurance": row.insurance or "",
+            "Charges": money(row.fee),
+            "Paid": money(row.payment),
+        }
+        line = ""
+        for field, width, right_aligned in CMS1500_COLUMNS:
+            value = fields[field][:width]
+            line += value.rjust(width) if right_aligned else value.ljust(width)
+        yield line
+
+def export_rows(rows, fieldnames, path, export_format="csv"):
+    """Stream the checked rows to the file at path, in one of EXPORT_FORMATS.
+       Nothing but the rows themselves is held in memory."""
+    assert export_format in EXPORT_FORMATS
+    with metrics.timer("export", format=export_format, rows=len(rows)):
+        if export_format == "xlsx":
+            write_xlsx_file(path, fieldnames, checked_row_dicts(rows, fieldnames))
+        elif export_format == "cms1500":
+            write_text_file(path, cms1500_lines(rows))
+        else:
+            write_csv_file(path, fieldnames, checked_row_dicts(rows, fieldnames))
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+import json, random, threading
+from copy import copy
+from datetime import datetime, timedelta, timezone
+from time import sleep
+
+from instrumentation import metrics
+
+# A backend hands the CalendarManager the events between two days, as
+# iCloud-style event dicts. Only these keys are used:
+#   {"guid": ..., "title": ..., "duration": minutes, "etag": ...,
+#    "localStartDate": [yyyymmdd, year, month, day, hour, minute, minute of day]}
+
+def event_dict(guid, title, start, duration, etag="1"):
+    """Build an iCloud-style event dict for an event starting at the datetime start"""
+    return {
+        "guid": guid,
+        "title": title,
+        "duration": int(duration),
+        "etag": etag,
+        "localStartDate": [int(start.strftime("%Y%m%d")), start.year, start.month, start.day,
+                           start.hour, start.minute, start.hour * 60 + start.minute],
+    }
+
+class CalendarBackend(object):
+    """Somewhere to download calendar events from.
+       Subclasses implement events_between(start, end). fetch_events() wraps it,
+       counting requests and adding latency seconds (plus up to jitter more)
+       to every request, to stand in for a real network round trip."""
+
+    # HTTP statuses worth retrying a download after: rate limited, or a gateway hiccup
+    TRANSIENT_STATUSES = (429, 502, 503, 504)
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        super(CalendarBackend, self).__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def fetch_events(self, start, end):
+        """Returns the event dicts of every event from start's day to end's day"""
+        with self.lock:
+            self.requests += 1
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            sleep(delay)
+        return self.events_between(start, end)
+
+    def events_between(self, start, end):
+        raise NotImplementedError
+
+    def is_transient(self, error):
+        """Is error worth retrying (the network or the server having a bad
+           moment), rather than one that would only happen again, like
+           being logged out?"""
+        status = getattr(getattr(error, "response", None), "status_code", None)
+        if status is not None:
+            return status in self.TRANSIENT_STATUSES
+        return isinstance(error, (ConnectionError, TimeoutError))
+
+class ICloudBackend(CalendarBackend):
+    """Events from a logged in pyicloud session"""
+
+    def __init__(self, icloud):
+        super(ICloudBackend, self).__init__()
+        self.icloud = icloud
+
+    def events_between(self, start, end):
+        # The calendar service keeps the last response on itself, so each
+        # download works on its own shallow copy of it (sharing the session).
+        cal = copy(self.icloud.calendar)
+        cal.refresh_client(from_dt=start, to_dt=end)
+        # pyicloud only keeps the decoded response, so count the size of
+        # the events as JSON, which is about what came over the wire
+        metrics.count("calendar.download.bytes", len(json.dumps(cal.response['Event'])))
+        return cal.response['Event']
+
+    def is_transient(self, error):
+        from pyicloud.exceptions import PyiCloudAPIResponseException
+        import requests
+
+        if isinstance(error, PyiCloudAPIResponseException):
+            # pyicloud reports an expired session as 421, 450 or 500, which retrying won't fix
+            try:
+                return int(error.code) in self.TRANSIENT_STATUSES
+            except (TypeError, ValueError):
+                return False
+        if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            return True
+        return super(ICloudBackend, self).is_transient(error)
+
+class ICSFileBackend(CalendarBackend):
+    """Events from an exported .ics (iCalendar) file.
+       Daily and weekly recurring events are expanded (with INTERVAL, COUNT,
+       UNTIL, BYDAY, EXDATE and moved occurrences). Other recurrences only
+       appear on their first date."""
+
+    WEEKDAYS = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+
+    def __init__(self, path, latency=0.0, jitter=0.0):
+        super(ICSFileBackend, self).__init__(latency, jitter)
+        self.path = path
+        with open(path, encoding="utf-8") as ics_file:
+            self.components = self.parse_components(ics_file.read())
+
+        # Moved or edited occurrences of a recurring event replace the original
+        self.overrides = {}
+        for component in self.components:
+            if "RECURRENCE-ID" in component:
+                self.overrides.setdefault(component["UID"][1], set()).add(self.parse_time(*component["RECURRENCE-ID"]))
+
+    @staticmethod
+    def parse_components(text):
+        """Returns one {NAME: (params, value)} dict per VEVENT in the iCalendar text"""
+        # Lines starting with a space or tab continue the previous line
+        lines = []
+        for line in text.splitlines():
+            if line[:1] in (" ", "\t") and lines:
+                lines[-1] += line[1:]
+            elif line:
+                lines.append(line)
+
+        components = []
+        current = None
+        for line in lines:
+            if line == "BEGIN:VEVENT":
+                current = {}
+            elif line == "END:VEVENT":
+                if current is not None and "DTSTART" in current:
+                    components.append(current)
+                current = None
+            elif current is not None and ":" in line:
+                name, value = line.split(":", 1)
+                name, _, params = name.partition(";")
+                current.setdefault(name.upper(), (params.upper(), value))
+                if name.upper() == "EXDATE":
+                    current.setdefault("EXDATES", []).append((params.upper(), value))
+        return components
+
+    @staticmethod
+    def parse_time(params, value):
+        """Turn an iCalendar DATE or DATE-TIME into a naive local datetime"""
+        value = value.strip()
+        if ("VALUE=DATE" in params and "DATE-TIME" not in params) or len(value) == 8:
+            return datetime.strptime(value[:8], "%Y%m%d")
+        if value.endswith("Z"):
+            utc_time = datetime.strptime(value[:-1], "%Y%m%dT%H%M%S").replace(tzinfo=timezone.utc)
+            return utc_time.astimezone().replace(tzinfo=None)
+        # Times with a TZID are taken as local, like the rest of the AutoBiller
+        return datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+
+    @staticmethod
+    def parse_duration(value):
+        """Turn an iCalendar DURATION (e.g. PT50M, P1D) into minutes"""
+        minutes, number = 0, ""
+        units = {"W": 7 * 24 * 60, "D": 24 * 60, "H": 60, "M": 1, "S": 1 / 60}
+        for char in value.lstrip("+").lstrip("P"):
+            if char.isdigit():
+                number += char
+            elif char in units and number:
+                minutes += int(number) * units[char]
+                number = ""
+        return int(minutes)
+
+    @staticmethod
+    def unescape(text):
+        return text.replace("\\n", "\n").replace("\\N", "\n").replace("\\,", ",").replace("\\;", ";").replace("\\\\", "\\")
+
+    def duration_of(self, component, start):
+        if "DTEND" in component:
+            return int((self.parse_time(*component["DTEND"]) - start).total_seconds() // 60)
+        if "DURATION" in component:
+            return self.parse_duration(component["DURATION"][1])
+        return 0
+
+    def occurrences(self, component, start, first_day, last_day):
+        """The start times of every occurrence of component between the two days"""
+        rule = dict(part.split("=", 1) for part in component.get("RRULE", ("", ""))[1].split(";") if "=" in part)
+        if rule.get("FREQ") not in ("DAILY", "WEEKLY") or "RECURRENCE-ID" in component:
+            if first_day <= start < last_day + timedelta(days=1):
+                yield start
+            return
+
+        interval = int(rule.get("INTERVAL", 1))
+        count = int(rule["COUNT"]) if "COUNT" in rule else None
+        until = self.parse_time("", rule["UNTIL"]) if "UNTIL" in rule else None
+        excluded = set(self.overrides.get(component["UID"][1], ()))
+        for params, value in component.get("EXDATES", []):
+            excluded.update(self.parse_time(params, v) for v in value.split(","))
+
+        if rule["FREQ"] == "WEEKLY":
+            weekdays = sorted(self.WEEKDAYS.index(day[-2:]) for day in rule.get("BYDAY", self.WEEKDAYS[start.weekday()]).split(","))
+            week_start = start - timedelta(days=start.weekday())
+            step = timedelta(weeks=interval)
+        else:
+            weekdays = [0]
+            week_start = start
+            step = timedelta(days=interval)
+
+        seen = 0
+        while True:
+            for weekday in weekdays:
+                occurrence = week_start + timedelta(days=weekday)
+                if occurrence < start:
+                    continue
+                if (until is not None and occurrence > until) or (count is not None and seen >= count) or occurrence.date() > last_day.date():
+                    return
+                seen += 1
+                if occurrence >= first_day and occurrence not in excluded:
+                    yield occurrence
+            week_start += step
+
+    def events_between(self, start, end):
+        first_day = datetime(start.year, start.month, start.day)
+        last_day = datetime(end.year, end.month, end.day)
+        events = []
+        for component in self.components:
+            uid = component.get("UID", ("", ""))[1]
+            title = self.unescape(component.get("SUMMARY", ("", ""))[1])
+            etag = component.get("SEQUENCE", ("", "0"))[1] + component.get("LAST-MODIFIED", ("", ""))[1]
+            dtstart = self.parse_time(*component["DTSTART"])
+            duration = self.duration_of(component, dtstart)
+            for occurrence in self.occurrences(component, dtstart, first_day, last_day):
+                # Each occurrence of a recurring event is its own event, named after its original time
+                guid = uid
+                if "RECURRENCE-ID" in component:
+                    guid = "{}*{}".format(uid, self.parse_time(*component["RECURRENCE-ID"]).strftime("%Y%m%dT%H%M%S"))
+                elif "RRULE" in component:
+                    guid = "{}*{}".format(uid, occurrence.strftime("%Y%m%dT%H%M%S"))
+                events.append(event_dict(guid, title, occurrence, duration, etag))
+        return events
+
+def synthetic_names(count, seed=0):
+    """count distinct, made up "First Last" client names"""
+    first_names = ["Alex", "Jordan", "Taylor", "Morgan", "Casey", "Riley", "Jamie", "Avery", "Quinn", "Rowan",
+                   "Sam", "Charlie", "Dana", "Emerson", "Finley", "Harper", "Kai", "Logan", "Parker", "Reese"]
+    last_names = ["Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez",
+                  "Martinez", "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Moore",
+                  "Jackson", "Martin", "Lee", "Thompson", "White", "Harris", "Clark", "Lewis", "Walker"]
+    rng = random.Random(seed)
+    names = []
+    seen = set()
+    while len(names) < count:
+        name = "{} {}".format(rng.choice(first_names), rng.choice(last_names))
+        if name in seen:
+            # Tell apart clients with the same name the way a calendar would
+            name = "{} {}.".format(name, len(names))
+        seen.add(name)
+        names.append(name)
+    return names
+
+class SyntheticBackend(CalendarBackend):
+    """A made up calendar, for benchmarking without an iCloud account.
+       Every day gets events_per_day sessions titled after one of the given
+       titles (and sometimes something unbillable), from 8AM on. The events
+       of a day only depend on seed and the day, so any span of any length,
+       downloaded in any order, always gives back the same events.
+       Bump version to make every event look edited."""
+
+    DURATIONS = (30, 45, 50, 53, 60, 90)
+    OTHER_TITLES = ("Lunch", "Supervision", "Team meeting", "Notes", "Dentist")
+
+    def __init__(self, titles=None, events_per_day=6, weekends=False, other_rate=0.1,
+                 seed=0, latency=0.0, jitter=0.0):
+        super(SyntheticBackend, self).__init__(latency, jitter)
+        self.titles = list(titles) if titles else synthetic_names(50, seed)
+        self.events_per_day = events_per_day
+        self.weekends = weekends
+        self.other_rate = other_rate
+        self.seed = seed
+        self.version = 1
+
+    def events_on(self, day):
+        if not self.weekends and day.weekday() >= 5:
+            return []
+        rng = random.Random(self.seed * 1000003 + day.toordinal())
+        events = []
+        for number in range(self.events_per_day):
+            title = rng.choice(self.OTHER_TITLES) if rng.random() < self.other_rate else rng.choice(self.titles)
+            start = day + timedelta(hours=8 + number, minutes=rng.choice((0, 0, 0, 15, 30)))
+            guid = "synthetic-{}-{}-{}".format(self.seed, day.strftime("%Y%m%d"), number)
+            events.append(event_dict(guid, title, start, rng.choice(self.DURATIONS), str(self.version)))
+        return events
+
+    def events_between(self, start, end):
+        day = datetime(start.year, start.month, start.day)
+        last_day = datetime(end.year, end.month, end.day)
+        events = []
+        while day <= last_day:
+            events.extend(self.events_on(day))
+            day += timedelta(days=1)
+        return events
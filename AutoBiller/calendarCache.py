@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import json, sqlite3, threading
+from datetime import datetime
+
+from calendarLogic import *
+from utils import get_account_path
+
+class EventStore(object):
+    """An on-disk (SQLite) cache of downloaded calendar events.
+
+       Events are keyed by their identity (the iCloud GUID when there is one)
+       and indexed by day. The store also remembers which date ranges have
+       been downloaded (merged, one row per span of days), so a range that has
+       already been seen never needs to be downloaded again. Syncing is what
+       brings a stored range up to date (see CalendarManager.sync_date_range)."""
+
+    def __init__(self, path):
+        super(EventStore, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                key TEXT PRIMARY KEY,
+                day INTEGER NOT NULL,
+                start TEXT NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS events_by_day ON events (day, start);
+            CREATE TABLE IF NOT EXISTS covered (
+                start INTEGER PRIMARY KEY,
+                end INTEGER NOT NULL
+            );
+        """)
+
+        # Keep the covered ranges in memory, so lookups don't touch the disk
+        self.covered = DateRangeIndex()
+        for start, end in self.connection.execute("SELECT start, end FROM covered"):
+            self.covered.cover(DateRange(datetime.fromordinal(start), datetime.fromordinal(end)))
+        self.migrate()
+
+    def migrate(self):
+        """Stores used to add a row to a ranges table on every save. Merge those into covered."""
+        if not self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'ranges'").fetchone():
+            return
+        for start, end in self.connection.execute("SELECT start, end FROM ranges"):
+            self.covered.cover(DateRange(datetime.fromordinal(start), datetime.fromordinal(end)))
+        with self.connection:
+            self.connection.execute("DELETE FROM covered")
+            self.connection.executemany("INSERT INTO covered VALUES (?, ?)",
+                                        [(dr.start.toordinal(), dr.end.toordinal()) for dr in self.covered])
+            self.connection.execute("DROP TABLE ranges")
+
+    @classmethod
+    def for_account(cls, username):
+        """Open the store belonging to the given iCloud account"""
+        return cls(get_account_path(username, "calendar", "sqlite"))
+
+    def missing(self, date_range):
+        """Returns the sub-ranges of date_range that have never been saved"""
+        with self.lock:
+            return self.covered.missing(date_range)
+
+    def save_date_range(self, date_range, events):
+        """Replace everything stored within date_range with the given events"""
+        first, last = date_range.start.toordinal(), date_range.end.toordinal()
+        rows = [(e.identity(), e.day.toordinal(), e.date.isoformat(), json.dumps(e.calendar_dict))
+                for e in events]
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM events WHERE day BETWEEN ? AND ?", (first, last))
+            self.connection.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)", rows)
+            # Replace the rows date_range touches with the one span they're merged into
+            self.covered.cover(date_range)
+            span = self.covered.find(date_range.start)
+            self.connection.execute("DELETE FROM covered WHERE start <= ? AND end >= ?",
+                                    (span.end.toordinal() + 1, span.start.toordinal() - 1))
+            self.connection.execute("INSERT INTO covered VALUES (?, ?)", (span.start.toordinal(), span.end.toordinal()))
+
+    def load_events(self, date_range):
+        """Returns a sorted list of the stored events within date_range"""
+        first, last = date_range.start.toordinal(), date_range.end.toordinal()
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT data FROM events WHERE day BETWEEN ? AND ? ORDER BY start", (first, last)
+            ).fetchall()
+        return list(parse_events(json.loads(data) for (data,) in rows))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,9 +1,97 @@
 # -*- coding: utf-8 -*-
 
+import heapq, threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from concurrent.futures import Future
 from datetime import datetime, timedelta
+from time import sleep
+
+from calendarBackends import *
+from instrumentation import metrics
+from jobScheduler import scheduler, current_job, shared_pool, JobCancelled, BACKGROUND
+
+ONE_DAY = timedelta(days=1)
+
+EPOCH = datetime(1970, 1, 1)
+SECONDS_PER_DAY = 24 * 60 * 60
+
+def to_epoch(date):
+    """Seconds from the epoch to the given (naive, local) datetime"""
+    return int((date - EPOCH).total_seconds())
+
+def day_start_epoch(date):
+    """Seconds from the epoch to the midnight starting date's day"""
+    return to_epoch(date) // SECONDS_PER_DAY * SECONDS_PER_DAY
+
+class EventColumns(object):
+    """A columnar store of events, sorted by start time.
+       Start times and durations are kept in flat int64 arrays, next to the
+       titles and the CalendarEvent objects themselves, so range queries are
+       two binary searches over the start times."""
+
+    def __init__(self):
+        super(EventColumns, self).__init__()
+        self.starts = array("q")
+        self.durations = array("q")
+        self.titles = []
+        self.events = []
+
+    def __len__(self):
+        return len(self.events)
+
+    def copy(self):
+        copied = EventColumns()
+        copied.starts = array("q", self.starts)
+        copied.durations = array("q", self.durations)
+        copied.titles = list(self.titles)
+        copied.events = list(self.events)
+        return copied
+
+    def merge(self, *sorted_lists):
+        """Merge any number of date-sorted lists of events into the store,
+           in one linear pass. An event that is already in the store, or
+           that appears more than once, is only kept the first time
+           (events are matched by CalendarEvent.identity)."""
+        sorted_lists = [events for events in sorted_lists if events]
+        if not sorted_lists:
+            return
+        merged = []
+        seen = set()
+        for event in heapq.merge(self.events, *sorted_lists, key=lambda e: e.date):
+            key = event.identity()
+            if key not in seen:
+                seen.add(key)
+                merged.append(event)
+        self.set_sorted(merged)
+
+    def set_sorted(self, sorted_events):
+        """Replace the whole store with the given (sorted, duplicate-free) events"""
+        self.starts = array("q", (to_epoch(e.date) for e in sorted_events))
+        self.durations = array("q", (e.duration_in_min for e in sorted_events))
+        self.titles = [e.title for e in sorted_events]
+        self.events = sorted_events
+
+    def replace(self, lo, hi, sorted_events):
+        """Replace the events at positions [lo, hi) with sorted_events,
+           which must all start between the events on either side."""
+        self.starts[lo:hi] = array("q", (to_epoch(e.date) for e in sorted_events))
+        self.durations[lo:hi] = array("q", (e.duration_in_min for e in sorted_events))
+        self.titles[lo:hi] = [e.title for e in sorted_events]
+        self.events[lo:hi] = sorted_events
+
+    def positions_within(self, first_day, last_day):
+        """Returns (lo, hi) such that [lo, hi) are the positions of the
+           events on any day from first_day to last_day, inclusive."""
+        lo = bisect_left(self.starts, day_start_epoch(first_day))
+        hi = bisect_left(self.starts, day_start_epoch(last_day) + SECONDS_PER_DAY, lo)
+        return lo, hi
 
 class DateRange(object):
-    """A wrapper for a tuple of DateTime objects."""
+    """A wrapper for a tuple of DateTime objects.
+       Both ends are inclusive, and the events are kept in an EventColumns
+       store, sorted by date."""
 
     def __init__(self, start, end):
         super(DateRange, self).__init__()
@@ -12,7 +100,17 @@ class DateRange(object):
         self.start = start
         self.end = end
 
-        self.events = []
+        self.columns = EventColumns()
+
+    @property
+    def events(self):
+        return self.columns.events
+
+    def copy(self):
+        """A copy of this DateRange, with its own copy of the events list"""
+        copied = DateRange(self.start, self.end)
+        copied.columns = self.columns.copy()
+        return copied
 
     def set_start(self, new_start):
         self.start = new_start
@@ -21,7 +119,14 @@ class DateRange(object):
         self.end = new_end
 
     def add_events(self, new_events):
-        self.events.extend(new_events)
+        """Add new_events, keeping self.events sorted by date and
+           skipping any event that is already here"""
+        self.columns.merge(sorted(new_events, key=lambda e: e.date))
+
+    def remove_events(self, old_events):
+        """Remove old_events (these very CalendarEvent objects) from self.events"""
+        unwanted = {id(e) for e in old_events}
+        self.columns.set_sorted([e for e in self.events if id(e) not in unwanted])
 
     def get_events(self):
         return self.events
@@ -41,142 +146,645 @@ class DateRange(object):
     def all_events_within(self, sub_dr):
         """Returns a sorted list of all events within both self and sub_dr"""
         assert type(sub_dr) == DateRange
-        events_within_timeframe = []
-        for event in self.events:
-            if sub_dr.contains(event):
-                events_within_timeframe.append(event)
-        events_within_timeframe.sort(key=lambda e: e.date)
-        return events_within_timeframe
+        lo, hi = self.columns.positions_within(sub_dr.start, sub_dr.end)
+        return self.events[lo:hi]
+
+    def patch_events(self, sub_dr, fresh_events):
+        """Replace the events within sub_dr with fresh_events, touching only
+           the ones that were added, changed or deleted. Unchanged events
+           keep their old CalendarEvent objects, and changed events are
+           replaced by their fresh ones (the old objects may still be in a
+           published snapshot, so they're never changed).
+
+           RETURNS: a tuple of lists (added, changed, removed)"""
+        lo, hi = self.columns.positions_within(sub_dr.start, sub_dr.end)
+        old_by_key = {e.identity(): e for e in self.events[lo:hi]}
+
+        patched, added, changed = [], [], []
+        for event in fresh_events:
+            if not sub_dr.contains(event.day):
+                continue
+            old_event = old_by_key.pop(event.identity(), None)
+            if old_event is None:
+                added.append(event)
+                patched.append(event)
+            elif old_event.is_same_version(event):
+                patched.append(old_event)
+            else:
+                changed.append(event)
+                patched.append(event)
+        removed = list(old_by_key.values())
+
+        if added or changed or removed:
+            patched.sort(key=lambda e: e.date)
+            self.columns.replace(lo, hi, patched)
+        return added, changed, removed
 
     def __repr__(self):
         return "({}, {})".format(self.start.strftime("%m/%d/%Y"), self.end.strftime("%m/%d/%Y"))
 
+class DateRangeIndex(object):
+    """A sorted list of non-overlapping DateRanges, searchable by bisection.
+       Two ranges that touch (one ends the day before the other starts)
+       are considered part of the same span."""
+
+    def __init__(self):
+        super(DateRangeIndex, self).__init__()
+        self.ranges = []
+        self.starts = []
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __getitem__(self, index):
+        return self.ranges[index]
+
+    def copy(self):
+        """A copy of the index. The DateRanges themselves are shared."""
+        copied = DateRangeIndex()
+        copied.ranges = list(self.ranges)
+        copied.starts = list(self.starts)
+        return copied
+
+    def overlapping(self, date_range):
+        """Returns (lo, hi) such that self.ranges[lo:hi] are exactly
+           the ranges that overlap or touch date_range."""
+        lo = bisect_left(self.starts, date_range.start)
+        if lo > 0 and self.ranges[lo - 1].end + ONE_DAY >= date_range.start:
+            lo -= 1
+        hi = bisect_right(self.starts, date_range.end + ONE_DAY)
+        return lo, hi
+
+    def find(self, day):
+        """Returns the DateRange containing day, or None"""
+        index = bisect_right(self.starts, day) - 1
+        if index >= 0 and self.ranges[index].contains(day):
+            return self.ranges[index]
+        return None
+
+    def covering(self, date_range):
+        """Returns the DateRange that covers all of date_range, or None"""
+        dr = self.find(date_range.start)
+        if dr and dr.end >= date_range.end:
+            return dr
+        return None
+
+    def missing(self, date_range):
+        """Returns a sorted list of the DateRanges within date_range
+           that aren't covered by anything in the index."""
+        gaps = []
+        cursor = date_range.start
+        lo, hi = self.overlapping(date_range)
+        for dr in self.ranges[lo:hi]:
+            if dr.start > cursor:
+                gaps.append(DateRange(cursor, min(dr.start - ONE_DAY, date_range.end)))
+            cursor = max(cursor, dr.end + ONE_DAY)
+        if cursor <= date_range.end:
+            gaps.append(DateRange(cursor, date_range.end))
+        return gaps
+
+    def cover(self, date_range):
+        """Mark date_range as covered, merging it with any ranges it touches.
+           Only the dates are kept, not the events."""
+        lo, hi = self.overlapping(date_range)
+        start, end = date_range.start, date_range.end
+        if lo < hi:
+            start = min(start, self.ranges[lo].start)
+            end = max(end, self.ranges[hi - 1].end)
+        self.replace(lo, hi, DateRange(start, end))
+
+    def replace(self, lo, hi, *new_drs):
+        """Replace self.ranges[lo:hi] with new_drs (sorted, and not touching each other)"""
+        self.ranges[lo:hi] = new_drs
+        self.starts[lo:hi] = [dr.start for dr in new_drs]
+
+    def __repr__(self):
+        return repr(self.ranges)
+
+class Prefetcher(object):
+    """Decides how far ahead (or behind) a CalendarManager should download.
+
+       It watches the recent queries, and if they move forwards or
+       backwards through the calendar, it prefetches in that direction,
+       doubling the window each time the pattern continues. Random
+       access gets no prefetch at all. Prefetches run in the background,
+       after the requested days have already been returned, as background
+       jobs on the shared scheduler, so they never hold up a user's query
+       waiting for a worker."""
+
+    # Number of recent queries to remember
+    HISTORY = 8
+    # Prefetch window (in days) when there is no history yet, and the largest window
+    FIRST_WINDOW = 2
+    MAX_WINDOW = 42
+    # A query that starts within SEQUENTIAL_GAP days of the last one continues its pattern
+    SEQUENTIAL_GAP = 3
+
+    def __init__(self, manager, background=True):
+        super(Prefetcher, self).__init__()
+        self.manager = manager
+        self.background = background
+        self.history = deque(maxlen=self.HISTORY)
+        self.pattern = None
+        self.streak = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.prefetched_days = 0
+        self.errors = 0
+
+    def record(self, date_range, hit):
+        """Remember a query, and whether it was already cached"""
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            pattern = "random"
+            if self.history:
+                last = self.history[-1]
+                gap = timedelta(days=self.SEQUENTIAL_GAP)
+                if last.end < date_range.start <= last.end + gap:
+                    pattern = "forward"
+                elif last.start - gap <= date_range.end < last.start:
+                    pattern = "backward"
+            else:
+                pattern = None
+
+            if pattern == self.pattern and pattern in ("forward", "backward"):
+                self.streak += 1
+            else:
+                self.streak = 1
+            self.pattern = pattern
+            self.history.append(date_range)
+
+    def window(self):
+        """How many days to prefetch after the last query"""
+        if self.pattern is None:
+            return self.FIRST_WINDOW
+        if self.pattern == "random":
+            return 0
+        return min(self.MAX_WINDOW, self.FIRST_WINDOW * 2 ** self.streak)
+
+    def next_range(self, date_range):
+        """The DateRange to prefetch after date_range, or None"""
+        window = self.window()
+        if window == 0:
+            return None
+        if self.pattern == "backward":
+            return DateRange(date_range.start - timedelta(days=window), date_range.start - ONE_DAY)
+        return DateRange(date_range.end + ONE_DAY, date_range.end + timedelta(days=window))
+
+    def prefetch_after(self, date_range):
+        """Prefetch whatever should come after date_range"""
+        next_dr = self.next_range(date_range)
+        if next_dr is None:
+            return
+        if not self.background:
+            self.prefetch(next_dr)
+        else:
+            # Never queue up more than one prefetch at a time: while one is
+            # queued or running, this just subscribes to it
+            scheduler.submit(self.prefetch, next_dr, priority=BACKGROUND, key=("prefetch", id(self)))
+
+    def prefetch(self, date_range):
+        """Download date_range into the manager, if it isn't there already"""
+        try:
+            gaps = self.manager.date_ranges.missing(date_range)
+            if not gaps:
+                return
+            self.manager.add_to_index(date_range)
+            days = sum((gap.end - gap.start).days + 1 for gap in gaps)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            return
+        with self.lock:
+            self.prefetches += 1
+            self.prefetched_days += days
+
+    def stats(self):
+        """Hit/miss statistics, for tuning"""
+        with self.lock:
+            queries = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / queries if queries else 0.0,
+                "prefetches": self.prefetches,
+                "prefetched_days": self.prefetched_days,
+                "errors": self.errors,
+                "pattern": self.pattern,
+                "window": self.window(),
+            }
+
 class CalendarManager(object):
     """An object to manage the calendar information, seperate from iCloud."""
 
-    TIME_DELTA = 7
+    # Downloads are split into chunks of CHUNK_DAYS days, and the chunks of
+    # every CalendarManager share one pool of MAX_WORKERS download threads.
+    # A failed chunk is retried up to MAX_RETRIES times, waiting
+    # RETRY_BACKOFF * 2^attempt seconds.
+    CHUNK_DAYS = 14
+    MAX_WORKERS = 8
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = 0.5
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, store=None, backend=None):
         super().__init__()
         self.parent = parent
-        self.date_ranges = []
+        self.store = store
+        self.backend = backend
+        # date_ranges is copy-on-write: a DateRangeIndex (or a DateRange in it)
+        # is never changed once it's been published here. Readers just take
+        # the current one, with no lock. Writers hold self.lock, build a new
+        # index, and publish it by replacing self.date_ranges. CalendarEvents
+        # aren't changed either: a changed event is a new object.
+        # self.lock also guards in_flight, but is never held while downloading.
+        self.date_ranges = DateRangeIndex()
+        self.in_flight = []
+        self.lock = threading.RLock()
+        self.prefetcher = Prefetcher(self)
+        self.client_index = None
 
     def icloud(self):
         return self.parent.icloud
 
-    def download_date_range(self, date_range):
-        """Download calendar data within the specified date range"""
-        cal = self.icloud().calendar
-        cal.refresh_client(from_dt=date_range.start,to_dt=date_range.end)
-
-        return [CalendarEvent(event) for event in cal.response['Event']]
-
-    def add_one_day(self, date):
-        """Pre-download TIME_DELTA days in advance"""
-        date_and_extra = DateRange(date, date + timedelta(days=self.TIME_DELTA))
-        events = self.add_date_range(date_and_extra)
-        events_of_day = [e for e in events if e.day == date]
-        return events_of_day
-
-    def add_date_range(self, date_range):
+    def calendar_backend(self):
+        """Where events are downloaded from: the given backend, or else the parent's iCloud session"""
+        if self.backend is None:
+            return ICloudBackend(self.icloud())
+        return self.backend
+
+    def use_backend(self, backend):
+        """Download events from the given CalendarBackend"""
+        self.backend = backend
+
+    def use_store(self, store):
+        """Read and save events through the given on-disk EventStore"""
+        self.store = store
+
+    def use_client_index(self, client_index):
+        """Keep the given ClientEventIndex up to date with every event downloaded"""
+        with self.lock:
+            self.client_index = client_index
+            client_index.add_events([e for dr in self.date_ranges for e in dr.get_events()])
+
+    def download_date_ranges(self, date_ranges):
+        """Download calendar data for several date ranges at once.
+           Each range is split into chunks of CHUNK_DAYS days, downloaded
+           in parallel on the shared download pool.
+           When run as a job, it reports progress after each chunk, and
+           stops early if the job is cancelled.
+
+           RETURNS: a list with the sorted events of each date range, in order"""
+        chunks_by_dr = [self.split_into_chunks(dr) for dr in date_ranges]
+        all_chunks = [chunk for chunks in chunks_by_dr for chunk in chunks]
+        if not all_chunks:
+            return [[] for dr in date_ranges]
+
+        job = current_job()
+        def download(chunk):
+            # The chunk threads aren't the job's, so check on it here
+            if job is not None and job.cancelled():
+                raise JobCancelled()
+            return self.download_chunk_with_retry(chunk)
+
+        with metrics.timer("calendar.download", chunks=len(all_chunks)) as fields:
+            downloaded = []
+            if len(all_chunks) <= 1 or self.MAX_WORKERS <= 1:
+                for chunk in all_chunks:
+                    downloaded.append(download(chunk))
+                    if job is not None:
+                        job.report_progress(len(downloaded), len(all_chunks))
+            else:
+                # Not the scheduler, since a job waiting on jobs could fill it
+                pool = shared_pool("download", self.MAX_WORKERS)
+                for chunk_events in pool.map(download, all_chunks):
+                    downloaded.append(chunk_events)
+                    if job is not None:
+                        job.report_progress(len(downloaded), len(all_chunks))
+            fields["events"] = sum(len(chunk_events) for chunk_events in downloaded)
+        metrics.count("calendar.download.chunks", len(all_chunks))
+
+        # Put the chunks back together, in date order
+        events_by_dr = []
+        position = 0
+        for chunks in chunks_by_dr:
+            events = []
+            for chunk_events in downloaded[position:position + len(chunks)]:
+                events.extend(chunk_events)
+            position += len(chunks)
+            events.sort(key=lambda e: e.date)
+            events_by_dr.append(events)
+        return events_by_dr
+
+    def split_into_chunks(self, date_range):
+        """Split date_range into consecutive DateRanges of at most CHUNK_DAYS days"""
+        chunks = []
+        chunk_start = date_range.start
+        while chunk_start <= date_range.end:
+            chunk_end = min(chunk_start + timedelta(days=self.CHUNK_DAYS - 1), date_range.end)
+            chunks.append(DateRange(chunk_start, chunk_end))
+            chunk_start = chunk_end + ONE_DAY
+        return chunks
+
+    def download_chunk_with_retry(self, chunk):
+        """Download one chunk, retrying with exponential backoff if it fails
+           in a way the backend says is transient (e.g. a dropped connection)"""
+        for attempt in range(self.MAX_RETRIES):
+            try:
+                return self.download_chunk(chunk)
+            except Exception as error:
+                metrics.count("calendar.download.errors")
+                if attempt == self.MAX_RETRIES - 1 or not self.calendar_backend().is_transient(error):
+                    raise
+                sleep(self.RETRY_BACKOFF * 2 ** attempt)
+
+    def download_chunk(self, chunk):
+        """Download the calendar data within one chunk"""
+        with metrics.timer("calendar.fetch", log=False):
+            calendar_dicts = self.calendar_backend().fetch_events(chunk.start, chunk.end)
+
+        with metrics.timer("calendar.parse", log=False):
+            return list(parse_events(calendar_dicts, chunk))
+
+    def load_date_ranges(self, date_ranges, refresh=False):
+        """Returns the events within each of date_ranges. If there's an
+           on-disk store, only the parts it hasn't seen are downloaded (all
+           together), unless refresh is True: then everything is downloaded
+           again, and the store is brought up to date."""
+        if self.store is None:
+            return self.download_date_ranges(date_ranges)
+
+        if refresh:
+            missing = list(date_ranges)
+        else:
+            missing = [m_dr for dr in date_ranges for m_dr in self.store.missing(dr)]
+        for missing_dr, events in zip(missing, self.download_date_ranges(missing)):
+            self.store.save_date_range(missing_dr, events)
+        return [self.store.load_events(dr) for dr in date_ranges]
+
+    def add_one_day(self, date, sync=False):
+        """Returns the events of one day. The prefetcher then downloads
+           the days it expects to be asked for next, in the background.
+           If sync is True, an already-downloaded day is checked for changes."""
+        day = DateRange(date, date)
+        if sync:
+            self.sync_date_range(day)
+        return self.add_date_range(day)
+
+    def sync_date_range(self, date_range):
+        """Bring an already-added date range up to date with the calendar.
+           The range is downloaded again, but only the events that were added,
+           changed or deleted since the last download are patched into the
+           cached DateRange (and the on-disk store). Parts of date_range that
+           aren't in memory are downloaded afresh (not read from the store,
+           which may be out of date) and added.
+
+           RETURNS: a tuple of lists (added, changed, removed)"""
+        added, changed, removed = [], [], []
+        with self.lock:
+            lo, hi = self.date_ranges.overlapping(date_range)
+            sub_drs = [DateRange(max(dr.start, date_range.start), min(dr.end, date_range.end))
+                       for dr in self.date_ranges[lo:hi]]
+            # Leave out ranges that only touch date_range
+            sub_drs = [sub_dr for sub_dr in sub_drs if sub_dr.start <= sub_dr.end]
+            gaps = self.date_ranges.missing(date_range)
+
+        all_fresh_events = self.download_date_ranges(sub_drs)
+
+        with self.lock:
+            # Patch copies of the ranges, and publish them together
+            index = self.date_ranges.copy()
+            copies = {}
+            for sub_dr, fresh_events in zip(sub_drs, all_fresh_events):
+                # Ranges only ever grow, but sub_dr may have been merged into a new one meanwhile
+                position = bisect_right(index.starts, sub_dr.start) - 1
+                if position not in copies:
+                    copies[position] = index[position].copy()
+                    index.replace(position, position + 1, copies[position])
+                dr = copies[position]
+                sub_added, sub_changed, sub_removed = dr.patch_events(sub_dr, fresh_events)
+                if self.store is not None and (sub_added or sub_changed or sub_removed):
+                    self.store.save_date_range(sub_dr, dr.all_events_within(sub_dr))
+                added.extend(sub_added)
+                changed.extend(sub_changed)
+                removed.extend(sub_removed)
+            # A session rescheduled into date_range from a day outside it looks
+            # added, so its old copy is dropped from the same published index
+            moved = self.remove_old_copies(index, copies, added)
+            self.date_ranges = index
+        added, changed = self.split_moved(added, changed, moved)
+        self.update_client_index(added, changed, removed)
+
+        if gaps:
+            self.add_to_index(date_range, refresh=True)
+            with self.lock:
+                gap_events = [e for gap in gaps for e in self.events_within(gap)]
+                index = self.date_ranges.copy()
+                moved = self.remove_old_copies(index, {}, gap_events)
+                self.date_ranges = index
+            # add_to_index has already indexed the rest
+            gap_added, gap_moved = self.split_moved(gap_events, [], moved)
+            self.update_client_index([], gap_moved, [])
+            added.extend(gap_added)
+            changed.extend(gap_moved)
+        return added, changed, removed
+
+    def remove_old_copies(self, index, copies, events):
+        """Remove any other copy of events (the same identity, but another
+           CalendarEvent, e.g. where a rescheduled session used to be) from
+           index, replacing the DateRanges it changes with copies. copies maps
+           the positions in index already copied to their copies.
+           Should only be called while holding self.lock.
+
+           RETURNS: a list of (old copy, event) pairs"""
+        if not events:
+            return []
+        by_key = {e.identity(): e for e in events}
+        moved = []
+        for position, dr in enumerate(index):
+            old_copies = [e for e in dr.get_events()
+                          if by_key.get(e.identity(), e) is not e]
+            if not old_copies:
+                continue
+            if position not in copies:
+                copies[position] = dr.copy()
+                index.replace(position, position + 1, copies[position])
+            copies[position].remove_events(old_copies)
+            for old_event in old_copies:
+                moved.append((old_event, by_key[old_event.identity()]))
+                if self.store is not None:
+                    old_day = DateRange(old_event.day, old_event.day)
+                    self.store.save_date_range(old_day, copies[position].all_events_within(old_day))
+        return moved
+
+    def update_client_index(self, added, changed, removed):
+        """Bring the client index up to date with events added to, changed in
+           or removed from date_ranges. Matching events to clients can be slow,
+           so this is called after self.lock is released."""
+        if self.client_index is None:
+            return
+        # Changed events are found by identity, so this removes their old versions
+        self.client_index.remove_events(changed + removed)
+        self.client_index.add_events(added + changed)
+
+    @staticmethod
+    def split_moved(added, changed, moved):
+        """Moved events were changed, not added. RETURNS: (added, changed) without the moves in added"""
+        moved_keys = {event.identity() for old_event, event in moved}
+        return ([e for e in added if e.identity() not in moved_keys],
+                changed + [e for e in added if e.identity() in moved_keys])
+
+    def add_date_range(self, date_range, record=True):
         """A function that will perform the actions needed
            in order to add the specified DateRange to the
-           manager's date_ranges list. Then returns whichever
-           DateRange object contains all the event information
-           that happens within date_range.
-
-           NOTE: This should end up with all the date_ranges sorted
-           by date, but it doesn't. I think it's something about synchronicity.
-           Maybe downloads take some time? If I fix this, the searches become faster.
-           TODO: Fix the timing of the downloads. (And change searches to sorted)
-           """
+           manager's date_ranges index. Then returns a sorted list
+           of all the events that happen within date_range.
 
-        # Define the logic that will allow for the merging and deletion
-        # of date ranges in order tp consolidate everything
-        dr_focus = date_range
-        dr_focus_date = date_range.start
-        added_dr = False
-        added_anything = False
-        dr_to_delete = []
-        for index, old_dr in enumerate(self.date_ranges):
-            if old_dr.end < dr_focus.start:
-                # The older date_range is irrelevant
-                continue
+           Only the parts of date_range that haven't already been
+           downloaded are downloaded. Everything that overlaps or
+           touches date_range is then merged into a single DateRange,
+           so date_ranges always stays sorted and non-overlapping.
+
+           Unless record is False, the query is shown to the prefetcher.
+           """
+        with metrics.timer("calendar.add_date_range", days=(date_range.end - date_range.start).days + 1) as fields:
+            hit = self.date_ranges.covering(date_range) is not None
+            metrics.count("calendar.cache.hits" if hit else "calendar.cache.misses")
+            if record:
+                self.prefetcher.record(date_range, hit=hit)
+            events = self.add_to_index(date_range)
+            fields.update(hit=hit, events=len(events))
+
+        if record:
+            self.prefetcher.prefetch_after(date_range)
+        return events
+
+    def add_to_index(self, date_range, refresh=False):
+        """Download whatever is missing from date_range, merge it into
+           date_ranges, and return the sorted events within date_range.
+           If refresh is True, the missing parts are downloaded even if
+           they're in the on-disk store.
+
+           Downloads are single-flight: the parts of date_range that another
+           thread is already downloading aren't downloaded again. This waits
+           for that download instead, and only fetches the rest itself. If
+           the other download fails, its part is tried again here.
+           Must not be called while holding self.lock."""
+        while True:
+            # Already downloaded days are read without the lock
+            events = self.events_within(date_range)
+            if events is not None:
+                return events
+            with self.lock:
+                gaps = self.date_ranges.missing(date_range)
+                if not gaps:
+                    continue
+                waits, claims, claim = self.claim(gaps)
+
+            if claims:
+                try:
+                    downloads = self.load_date_ranges(claims, refresh)
+                except BaseException as error:
+                    with self.lock:
+                        self.release(claim)
+                    claim.set_exception(error)
+                    raise
+                with self.lock:
+                    for gap, events in zip(claims, downloads):
+                        gap.add_events(events)
+                    self.merge_gaps(claims)
+                    self.release(claim)
+                try:
+                    self.update_client_index([e for gap in claims for e in gap.get_events()], [], [])
+                finally:
+                    claim.set_result(None)
+
+            if waits:
+                metrics.count("calendar.download.coalesced", len(waits))
+            for other_claim in waits:
+                # If it failed, its part is still missing, and the next loop claims it
+                other_claim.exception()
+
+    def claim(self, gaps):
+        """Split gaps into the parts that are already being downloaded, and
+           the parts that aren't. The latter are claimed for the caller to
+           download, so no other thread downloads them too.
+           Should only be called while holding self.lock.
+
+           RETURNS: a tuple (the Futures of the downloads to wait for,
+                             a sorted list of the claimed DateRanges,
+                             the Future to resolve once they're merged in)"""
+        waits = []
+        claims = []
+        for gap in gaps:
+            cursor = gap.start
+            for span, other_claim in self.in_flight:
+                if span.end < gap.start or span.start > gap.end:
+                    continue
+                if other_claim not in waits:
+                    waits.append(other_claim)
+                if span.start > cursor:
+                    claims.append(DateRange(cursor, span.start - ONE_DAY))
+                cursor = max(cursor, span.end + ONE_DAY)
+            if cursor <= gap.end:
+                claims.append(DateRange(cursor, gap.end))
+
+        claim = Future()
+        self.in_flight.extend((span, claim) for span in claims)
+        self.in_flight.sort(key=lambda entry: entry[0].start)
+        return waits, claims, claim
+
+    def release(self, claim):
+        """Forget the spans of a finished claim. Should only be called while holding self.lock."""
+        self.in_flight = [(span, other_claim) for span, other_claim in self.in_flight if other_claim is not claim]
+
+    def merge_gaps(self, gaps):
+        """Merge the downloaded gaps (sorted, with their events) into date_ranges.
+           Each run of ranges that touch becomes a single DateRange, with one
+           k-way merge of their (already sorted) events. Parts still being
+           downloaded elsewhere split the runs, so they never look covered.
+           Should only be called while holding self.lock."""
+        index = self.date_ranges.copy()
+        lo, hi = index.overlapping(DateRange(gaps[0].start, gaps[-1].end))
+        pieces = sorted(index[lo:hi] + gaps, key=lambda dr: dr.start)
+
+        runs = []
+        run_end = None
+        for piece in pieces:
+            if runs and piece.start <= run_end + ONE_DAY:
+                runs[-1].append(piece)
+                run_end = max(run_end, piece.end)
             else:
-                added_anything = True
-            if old_dr.start > dr_focus.end:
-                break
-            if dr_focus == date_range and not added_dr and dr_focus.start < old_dr.start:
-                # Add the date_range if it starts it's own range and doesn't exist
-                index_to_insert_at = index
-                added_dr = True
-            if dr_focus == date_range and date_range.start >= old_dr.start and date_range.start <= old_dr.end:
-                # If the date_range starts in the middle of an older date_range,
-                # the old dr becomes the focus.
-                dr_focus = old_dr
-                dr_focus_date = dr_focus.end
-                self.extend_dr_forwards(dr_focus, date_range.end)
+                runs.append([piece])
+                run_end = piece.end
+
+        merged_drs = []
+        for run in runs:
+            if len(run) == 1:
+                merged_drs.append(run[0])
                 continue
-            if dr_focus_date < old_dr.start:
-                # Download from the dr_focus_date to the start of a downloaded segment
-                download_segment = DateRange(dr_focus_date, old_dr.start)
-                self.download_to_dr(dr_focus, download_segment)
-
-                dr_focus_date = old_dr.end
-            if old_dr.start >= dr_focus.start and old_dr.end <= dr_focus.end:
-                # The older date range is contained completely within
-                # either the new date_range or the extended date range
-                # (The value of dr_focus)
-                self.merge_dr(old_dr, dr_focus)
-                dr_to_delete.append(old_dr)
-            if old_dr.start <= dr_focus.end and old_dr.start >= dr_focus.start and old_dr.end >= dr_focus.end:
-                # The older date range lies on the boundary pf the dr in focus.
-                # The older dtae range should be deleted, and dr_focus extended
-                self.extend_dr_forwards(dr_focus, old_dr.end)
-                self.merge_dr(old_dr, dr_focus)
-                dr_to_delete.append(old_dr)
-                dr_focus_date = old_dr.end
-
-        # If the list is empty, or date_range goes at the end,
-        # just make this new one.
-        if len(self.date_ranges) == 0 or not added_anything:
-            self.date_ranges.append(date_range)
-            self.download_to_dr(date_range, date_range)
-            return date_range.get_events()
-
-        # Download the extra bit between the end of the last old dr and date_range
-        if dr_focus_date != dr_focus.end:
-            download_segment = DateRange(dr_focus_date, dr_focus.end)
-            self.download_to_dr(dr_focus, download_segment)
-
-        if added_dr:
-            self.date_ranges.insert(index_to_insert_at, date_range)
-
-        for dr in dr_to_delete:
-            self.date_ranges.remove(dr)
-            del dr
-
-        return dr_focus.all_events_within(date_range)
-
-    def merge_dr(self, dr_delete, dr_merge):
-        """Merge the data from dr_delete to dr_merge"""
-        dr_merge.add_events(dr_delete.get_events())
-
-    def extend_dr_forwards(self, dr_extend, new_end):
-        assert new_end >= dr_extend.end
-        dr_extend.set_end(new_end)
-
-    def download_to_dr(self, relevant_dr, download_dr):
-        """Download events that took place within download_dr, then move to relevant_dr"""
-        events = self.download_date_range(download_dr)
-
-        # Ensure the new events are being added to the right place
-        last_old_event = relevant_dr.get_last_event()
-        first_new_event = events[0]
-
-        assert not last_old_event or (first_new_event.date >= last_old_event.date)
-
-        relevant_dr.add_events(events)
+            merged = DateRange(run[0].start, max(dr.end for dr in run))
+            merged.columns.merge(*[dr.get_events() for dr in run])
+            merged_drs.append(merged)
+        index.replace(lo, hi, *merged_drs)
+        self.date_ranges = index
+
+    def events_within(self, date_range):
+        """Returns the cached events within date_range,
+           or None if date_range hasn't been fully downloaded."""
+        dr = self.date_ranges.covering(date_range)
+        if dr is None:
+            return None
+        return dr.all_events_within(date_range)
 
     def __repr__(self):
         readable = "["
@@ -185,18 +793,67 @@ class CalendarManager(object):
         readable += "]"
         return readable
 
+def parse_events(calendar_dicts, date_range=None):
+    """A generator that turns iCloud event dicts into CalendarEvents.
+       If date_range is given, events on other days are skipped before
+       anything is built for them."""
+    if date_range is None:
+        for calendar_dict in calendar_dicts:
+            yield CalendarEvent(calendar_dict)
+        return
+
+    first = (date_range.start.year, date_range.start.month, date_range.start.day)
+    last = (date_range.end.year, date_range.end.month, date_range.end.day)
+    for calendar_dict in calendar_dicts:
+        local_start = calendar_dict["localStartDate"]
+        if first <= (local_start[1], local_start[2], local_start[3]) <= last:
+            yield CalendarEvent(calendar_dict)
+
 class CalendarEvent(object):
-    """A wrapper for an event."""
+    """A wrapper for an event.
+       The start date is only decoded from the iCloud data when it's first used."""
+
+    __slots__ = ("calendar_dict", "guid", "title", "duration_in_min", "decoded_date", "decoded_day")
 
     def __init__(self, calendar_dict):
         super(CalendarEvent, self).__init__()
+        self.calendar_dict = calendar_dict
+        self.guid = calendar_dict.get("guid")
         self.title = calendar_dict.get("title")
+        self.duration_in_min = int(calendar_dict["duration"])
 
-        self.date = calendar_dict["localStartDate"]
-        self.day = datetime(self.date[1], self.date[2], self.date[3])
-        self.date = datetime(self.date[1], self.date[2], self.date[3], self.date[4], self.date[5])
+        self.decoded_date = None
+        self.decoded_day = None
 
-        self.duration_in_min = int(calendar_dict["duration"])
+    @property
+    def date(self):
+        if self.decoded_date is None:
+            local_start = self.calendar_dict["localStartDate"]
+            self.decoded_date = datetime(local_start[1], local_start[2], local_start[3], local_start[4], local_start[5])
+        return self.decoded_date
+
+    @property
+    def day(self):
+        if self.decoded_day is None:
+            local_start = self.calendar_dict["localStartDate"]
+            self.decoded_day = datetime(local_start[1], local_start[2], local_start[3])
+        return self.decoded_day
 
     def readable_date(self):
         return self.date.strftime("%I:%M %p, %m/%d/%Y")
+
+    def version(self):
+        """The iCloud etag of this event, or None if it doesn't have one"""
+        return self.calendar_dict.get("etag")
+
+    def is_same_version(self, other):
+        """Are self and other the same, unchanged, version of an event?"""
+        if self.version() is not None or other.version() is not None:
+            return self.version() == other.version()
+        return self.calendar_dict == other.calendar_dict
+
+    def identity(self):
+        """A key that stays the same across downloads of this event"""
+        if self.guid:
+            return self.guid
+        return "{}|{}|{}".format(self.date.isoformat(), self.title, self.duration_in_min)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import argparse, csv, os, sys
+from datetime import datetime
+
+from calendarLogic import *
+from calendarCache import *
+from practiceLogic import *
+from clientLogic import *
+from billingModel import *
+from instrumentation import metrics
+from sessionStore import login as open_session, close_all_sessions
+# Nothing in here may import PyQt5, so the AutoBiller can run without a display.
+
+def parse_date(text):
+    """Parse a YYYY-MM-DD command line date"""
+    try:
+        return datetime.strptime(text, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{}' is not a date in the form YYYY-MM-DD".format(text))
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="AutoBiller",
+                                     description="Run with no arguments to open the AutoBiller window.")
+    commands = parser.add_subparsers(dest="command")
+
+    bill = commands.add_parser("bill", help="Bill every session in a range of days, without the GUI")
+    bill.add_argument("--from", dest="start", type=parse_date, required=True,
+                      help="First day to bill (YYYY-MM-DD)")
+    bill.add_argument("--to", dest="end", type=parse_date, required=True,
+                      help="Last day to bill (YYYY-MM-DD)")
+    bill.add_argument("--out", required=True,
+                      help="File to write the report to")
+    bill.add_argument("--format", choices=EXPORT_FORMATS,
+                      help="Report format (default: guessed from --out, else csv)")
+    bill.add_argument("--username", dest="usernames", action="append",
+                      help="iCloud username (default: $AUTOBILLER_USERNAME). The password is read "
+                           "from $AUTOBILLER_PASSWORD, or the system keyring. Repeat to bill every "
+                           "clinician of a practice in one report.")
+    bill.add_argument("--ics",
+                      help="Bill from an exported .ics calendar file instead of iCloud")
+    bill.add_argument("--clients",
+                      help="CSV of clients: name, insurance, then any other billable names")
+    bill.add_argument("--group-by", choices=GROUP_BY,
+                      help="How to order the report (default: clinician for a practice, else day)")
+    bill.add_argument("--no-cache", action="store_true",
+                      help="Don't read or write the local calendar cache")
+    bill.add_argument("--metrics", metavar="FILE",
+                      help="Append a JSON line of timings for each stage to FILE")
+    return parser
+
+def load_clients(client_directory, path):
+    """Add the clients listed in a CSV file of name, insurance, other billable names..."""
+    with open(path, newline='') as clients_file:
+        for fields in csv.reader(clients_file):
+            fields = [field.strip() for field in fields]
+            if not fields or not fields[0]:
+                continue
+            insurance = fields[1] if len(fields) > 1 else ""
+            client = client_directory.add_client(fields[0], insurance)
+            for b_name in fields[2:]:
+                if b_name:
+                    client.add_billable_name(b_name)
+
+def login(username):
+    """Log in to iCloud without any prompts, resuming the window's saved session if it's still trusted"""
+    icloud, session = open_session(username, os.environ.get("AUTOBILLER_PASSWORD"))
+    if icloud.requires_2fa:
+        raise SystemExit("This iCloud session needs two-factor authentication. "
+                         "Log in once with the AutoBiller window, then try again.")
+    return icloud
+
+def bill_events(client_directory, events):
+    """Match every event (or (clinician, event)) against the clients. With
+       nobody to ask, matches that would need confirmation are left unbilled.
+
+       RETURNS: (list of BillingRows, number of unconfirmed matches)"""
+    rows = [BillingRow(event[1], event[0]) if isinstance(event, tuple) else BillingRow(event)
+            for event in events]
+    unconfirmed = 0
+    for row in rows:
+        session_data = client_directory.is_event_billable(row.event)
+        if session_data and client_directory.needs_confirmation(session_data):
+            unconfirmed += 1
+        elif session_data:
+            row.check(**session_data)
+    return rows, unconfirmed
+
+def bill(args):
+    """The bill command: download, match, and write one report"""
+    usernames = args.usernames or [name for name in [os.environ.get("AUTOBILLER_USERNAME")] if name]
+    if not usernames and not args.ics:
+        raise SystemExit("No iCloud username given (use --username or $AUTOBILLER_USERNAME)")
+    if len(usernames) > 1 and args.ics:
+        raise SystemExit("--ics bills one calendar, so only takes one --username")
+    start, end = min(args.start, args.end), max(args.start, args.end)
+    export_format = args.format
+    if export_format is None:
+        extension = os.path.splitext(args.out)[1].lstrip(".").lower()
+        export_format = "xlsx" if extension == "xlsx" else "csv"
+
+    client_directory = ClientDirectory()
+    if usernames and not args.no_cache:
+        # Decisions about which events are sessions are shared by the whole practice
+        client_directory.use_decisions(DecisionCache.for_account(usernames[0]))
+    if args.clients:
+        load_clients(client_directory, args.clients)
+
+    if len(usernames) > 1:
+        practice = PracticeManager()
+        for username in usernames:
+            store = None if args.no_cache else EventStore.for_account(username)
+            practice.add_account(username, CalendarManager(store=store, backend=ICloudBackend(login(username))))
+        events = practice.practice_events(DateRange(start, end), record=False)
+        header = PRACTICE_BILLING_HEADER
+        group_by = args.group_by or "clinician"
+    else:
+        if args.ics:
+            # A calendar file is already local, so it isn't cached
+            calendar_manager = CalendarManager(backend=ICSFileBackend(args.ics))
+        else:
+            calendar_manager = CalendarManager(backend=ICloudBackend(login(usernames[0])))
+            if not args.no_cache:
+                calendar_manager.use_store(EventStore.for_account(usernames[0]))
+        events = calendar_manager.add_date_range(DateRange(start, end), record=False)
+        header = RANGE_BILLING_HEADER
+        group_by = args.group_by or "day"
+
+    rows, unconfirmed = bill_events(client_directory, events)
+    sort_rows(rows, group_by)
+    export_rows(rows, header[1:], args.out, export_format)
+
+    totals = billing_totals(rows, group_by)
+    sessions, fees = totals["Total"]
+    print("Billed {} sessions ({}) from {} events to {}".format(sessions, fees, len(events), args.out))
+    if unconfirmed:
+        print("{} possible sessions need confirming in the AutoBiller window".format(unconfirmed),
+              file=sys.stderr)
+    return 0
+
+def main(argv):
+    args = build_parser().parse_args(argv)
+    if args.command == "bill":
+        if args.metrics:
+            metrics.use_log(args.metrics)
+        try:
+            return bill(args)
+        finally:
+            close_all_sessions()
+            metrics.write_summary()
+    build_parser().print_help()
+    return 2
@@ -1,5 +1,182 @@
 # -*- coding: utf-8 -*-
 
+import json, os, re, threading
+from datetime import timedelta
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+
+from instrumentation import metrics
+from utils import get_fees, get_account_path
+
+def name_tokens(text):
+    """Split a name or event title into lowercase alphanumeric tokens"""
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+def name_trigrams(text):
+    """The set of character trigrams of a name, padded at word boundaries"""
+    padded = "  " + " ".join(name_tokens(text)) + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def edit_distance(a, b, limit=None):
+    """The Levenshtein distance between two strings.
+       If limit is given, gives up and returns limit + 1 as soon as
+       the distance is known to be more than limit."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def similarity(a, b, floor=0.0):
+    """1.0 for identical strings, down to 0.0 for completely different ones.
+       Returns 0.0 without computing the edit distance if the difference in
+       length alone means the similarity can't be above floor."""
+    longest = max(len(a), len(b))
+    if longest == 0:
+        return 1.0
+    limit = int(longest * (1.0 - floor))
+    if abs(len(a) - len(b)) > limit:
+        return 0.0
+    return max(0.0, 1.0 - edit_distance(a, b, limit) / longest)
+
+def fuzzy_score(b_name, title, floor=0.0):
+    """How well the best-matching run of words in title matches b_name.
+       Word order and the spaces between initials are both forgiven,
+       so "Smith Jon" and "jsmith f/u" both score well against "Jon Smith".
+       Scores that can't beat floor aren't computed exactly."""
+    b_tokens = name_tokens(b_name)
+    title_tokens = name_tokens(title)
+    joined = " ".join(b_tokens)
+    unspaced = "".join(b_tokens)
+    in_order = " ".join(sorted(b_tokens))
+
+    best = floor
+    for size in range(max(1, len(b_tokens) - 1), len(b_tokens) + 2):
+        for i in range(len(title_tokens) - size + 1):
+            window = title_tokens[i:i + size]
+            best = max(best,
+                       similarity(" ".join(window), joined, best),
+                       similarity("".join(window), unspaced, best),
+                       similarity(" ".join(sorted(window)), in_order, best))
+            if best == 1.0:
+                return best
+    return best if best > floor else 0.0
+
+def cpt_for_duration(minutes):
+    """The individual psychotherapy CPT code for a session of the given length"""
+    if minutes < 16:
+        return "96152"
+    if minutes < 38:
+        return "90832"
+    if minutes < 53:
+        return "90834"
+    return "90837"
+
+def series_key(title):
+    """A key shared by every event in a recurring series with this title"""
+    return "title:" + " ".join(name_tokens(title or ""))
+
+class DecisionCache(object):
+    """Remembers the user's yes/no billability answers across sessions.
+
+       Each answer is stored under the event's identity (its GUID). A "yes"
+       is also stored under its normalized title, so it applies to the rest
+       of a recurring series; a "no" isn't, so one cancelled session never
+       hides the rest of the series. The cache is saved to a JSON file after each answer (or once
+       at the end of a batch()), and only the MAX_ENTRIES most recently used
+       answers are kept. A file that can't be read is started over."""
+
+    MAX_ENTRIES = 5000
+
+    def __init__(self, path=None):
+        super(DecisionCache, self).__init__()
+        self.path = path
+        self.lock = threading.Lock()
+        self.decisions = OrderedDict()
+        self.batches = 0
+        self.unsaved = False
+
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.decisions = OrderedDict(json.load(f))
+            except (OSError, ValueError, TypeError):
+                # Losing the answers is better than failing to log in
+                self.decisions = OrderedDict()
+
+    @classmethod
+    def for_account(cls, username):
+        """Open the decisions belonging to the given iCloud account"""
+        return cls(get_account_path(username, "decisions", "json"))
+
+    def record(self, client, event, billable):
+        """Remember that event is (or isn't) billable for client"""
+        decision = [client.name, billable]
+        keys = [event.identity(), series_key(event.title)] if billable else [event.identity()]
+        with self.lock:
+            for key in keys:
+                self.decisions[key] = decision
+                self.decisions.move_to_end(key)
+            while len(self.decisions) > self.MAX_ENTRIES:
+                self.decisions.popitem(last=False)
+            self.unsaved = True
+            if not self.batches:
+                self.save()
+
+    def clear(self):
+        """Forget every answer"""
+        with self.lock:
+            self.decisions.clear()
+            self.save()
+
+    @contextmanager
+    def batch(self):
+        """Save the answers recorded inside a with block once, at the end of it"""
+        with self.lock:
+            self.batches += 1
+        try:
+            yield self
+        finally:
+            with self.lock:
+                self.batches -= 1
+                if not self.batches and self.unsaved:
+                    self.save()
+
+    def lookup(self, event):
+        """Returns (client name, billable) for the event, or None.
+           An answer about the event itself beats one about its series."""
+        with self.lock:
+            decision = self.decisions.get(event.identity())
+            if decision is None:
+                decision = self.decisions.get(series_key(event.title))
+                # Files saved by older versions can have a "no" for a whole series
+                if decision is None or not decision[1]:
+                    return None
+                self.decisions.move_to_end(series_key(event.title))
+            else:
+                self.decisions.move_to_end(event.identity())
+            return tuple(decision)
+
+    def save(self):
+        """Write the decisions to disk. Should only be called while holding self.lock."""
+        if not self.path:
+            return
+        # Write a new file and swap it in, so a crash never leaves half a file
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w+") as f:
+            json.dump(list(self.decisions.items()), f)
+        os.replace(temp_path, self.path)
+        self.unsaved = False
+
 class Client(object):
     """A wrapper for a client."""
 
@@ -9,35 +186,173 @@ class Client(object):
         self.billable_names = [name]
         self.insurance = insurance
         self.copay = copay
+        self.directory = None
 
         self.relevant_calendar_events_by_billability = {}
 
     def add_billable_name(self, b_name):
         self.billable_names.append(b_name)
+        if self.directory:
+            self.directory.index_name(self, b_name)
 
     def add_billable_event(self, event):
-        self.relevant_calendar_events_by_billability[event] = True
+        self.change_event_billability(event, True)
 
     def add_unbillable_event(self, event):
-        self.relevant_calendar_events_by_billability[event] = False
+        self.change_event_billability(event, False)
 
     def change_event_billability(self, event, billability):
-        self.relevant_calendar_events_by_billability[event] = billability
+        # By identity, so the answer outlives a new version of the event
+        self.relevant_calendar_events_by_billability[event.identity()] = billability
+        if self.directory:
+            if self.directory.decisions:
+                self.directory.decisions.record(self, event, billability)
+            self.directory.answered(event)
 
 class ClientDirectory(object):
-    """An object that stores a list of Clients."""
+    """An object that stores a list of Clients.
+
+       Every billable name is indexed by its tokens, so matching an event
+       only looks at the names sharing a token with the event's title.
+       Titles with no exact match fall back to a fuzzy match, which uses a
+       trigram index to pick a few candidate names before computing any
+       edit distances."""
+
+    # Fuzzy matches not above FUZZY_THRESHOLD are ignored, and matches below
+    # CONFIRM_THRESHOLD should be confirmed by the user.
+    FUZZY_THRESHOLD = 0.7
+    CONFIRM_THRESHOLD = 0.9
+    # Only names sharing at least MIN_SHARED_TRIGRAMS of their trigrams with
+    # the title are scored, at most MAX_CANDIDATES of them.
+    MIN_SHARED_TRIGRAMS = 0.3
+    MAX_CANDIDATES = 8
 
     def __init__(self):
         super().__init__()
         self.clients = []
+        self.clients_by_name = {}
+        self.decisions = None
+        # Goes up whenever a change could alter which client any event belongs to
+        self.version = 0
+        # The ClientEventIndexes over this directory, told about each answer
+        self.event_indexes = []
+
+        # token -> list of (client, billable name, number of tokens in the name)
+        self.names_by_token = defaultdict(list)
+        # trigram -> list of (client, billable name, number of trigrams in the name)
+        self.names_by_trigram = defaultdict(list)
+        # title -> (client, billable name, confidence) or None
+        self.matches_by_title = {}
 
-    def add_client(self, name):
-        client = Client(name)
+    def add_client(self, name, insurance="", copay=None):
+        client = Client(name, insurance, copay)
+        client.directory = self
         self.clients.append(client)
+        self.clients_by_name[name] = client
+        for b_name in client.billable_names:
+            self.index_name(client, b_name)
+        return client
 
+    def use_decisions(self, decisions):
+        """Remember billability answers in the given DecisionCache"""
+        self.decisions = decisions
+        self.version += 1
+
+    def forget_decisions(self):
+        """Forget every billability answer, both this session's and the saved ones"""
+        for client in self.clients:
+            client.relevant_calendar_events_by_billability.clear()
+        if self.decisions is not None:
+            self.decisions.clear()
+        self.version += 1
+
+    def answered(self, event):
+        """A billability answer about event only changes where that event belongs"""
+        for event_index in self.event_indexes:
+            event_index.reindex_event(event)
+
+    @contextmanager
+    def batch_decisions(self):
+        """Save the billability answers given inside a with block once, at the end of it"""
+        if self.decisions is None:
+            yield
+        else:
+            with self.decisions.batch():
+                yield
+
+    def index_name(self, client, b_name):
+        """Add one of client's billable names to the token index"""
+        tokens = set(name_tokens(b_name))
+        for token in tokens:
+            self.names_by_token[token].append((client, b_name, len(tokens)))
+        trigrams = name_trigrams(b_name)
+        for trigram in trigrams:
+            self.names_by_trigram[trigram].append((client, b_name, len(trigrams)))
+        self.matches_by_title.clear()
+        self.version += 1
+
+    def match_client(self, title):
+        """Returns (client, billable name, confidence) for the name that best
+           matches the title, or None. Results are cached per title."""
+        title = title or ""
+        try:
+            return self.matches_by_title[title]
+        except KeyError:
+            pass
+        match = self.exact_match(title)
+        if match:
+            match = match + (1.0,)
+        else:
+            match = self.fuzzy_match(title)
+        # The cache may be cleared by another thread meanwhile, so return match itself
+        self.matches_by_title[title] = match
+        return match
+
+    def exact_match(self, title):
+        """Returns the (client, billable name) whose name best matches the
+           title, or None. A name matches if all of its tokens are in the
+           title, and longer names beat shorter ones."""
+        hits = defaultdict(int)
+        best = None
+        best_size = 0
+        for token in set(name_tokens(title)):
+            for client, b_name, size in self.names_by_token.get(token, ()):
+                hits[(client, b_name)] += 1
+                if hits[(client, b_name)] == size and size > best_size:
+                    best = (client, b_name)
+                    best_size = size
+        return best
+
+    def fuzzy_match(self, title):
+        """Returns (client, billable name, confidence) for the closest name
+           scoring above FUZZY_THRESHOLD, or None."""
+        shared = defaultdict(int)
+        sizes = {}
+        for trigram in name_trigrams(title):
+            for client, b_name, size in self.names_by_trigram.get(trigram, ()):
+                shared[(client, b_name)] += 1
+                sizes[(client, b_name)] = size
+
+        candidates = [key for key, count in shared.items()
+                      if count >= self.MIN_SHARED_TRIGRAMS * sizes[key]]
+        candidates.sort(key=lambda key: shared[key] / sizes[key], reverse=True)
+
+        best = None
+        floor = self.FUZZY_THRESHOLD
+        for client, b_name in candidates[:self.MAX_CANDIDATES]:
+            score = fuzzy_score(b_name, title, floor)
+            if score > floor:
+                best = (client, b_name, score)
+                floor = score
+        return best
+
+    @metrics.timed("clients.is_event_billable", log=False)
     def is_event_billable(self, event):
         """
-
+        Checks whether the event's title matches any client's billable names,
+        exactly or fuzzily. Events the client has marked as unbillable never
+        match, and events they have marked as billable have full confidence.
+        Answers remembered from earlier sessions skip the matching entirely.
 
         RETURNS: If the event is not billable for any client, returns None
                  Else, returns a dict in the form:
@@ -46,8 +361,128 @@ class ClientDirectory(object):
                     name = str,
                     cpt = str or None,
                     insurance = str or None,
-                    fee = str (iff cpt) or None
+                    fee = str (iff cpt) or None,
+                    confidence = float from 0 to 1
                  }
         """
-        # TODO: Implement event checking
-        return None
+        decision = self.decisions.lookup(event) if self.decisions else None
+        if decision and decision[0] in self.clients_by_name:
+            client = self.clients_by_name[decision[0]]
+            billability = decision[1]
+            confidence = 1.0
+        else:
+            match = self.match_client(event.title)
+            if match is None:
+                return None
+            client, b_name, confidence = match
+            billability = client.relevant_calendar_events_by_billability.get(event.identity())
+        if billability is False:
+            return None
+        if billability is True:
+            confidence = 1.0
+
+        cpt = cpt_for_duration(event.duration_in_min)
+        return {
+            "client": client,
+            "name": client.name,
+            "cpt": cpt,
+            "insurance": client.insurance or None,
+            "fee": str(get_fees()[cpt]),
+            "confidence": confidence,
+        }
+
+    def needs_confirmation(self, session_data):
+        """Should the user confirm this is_event_billable result?"""
+        return session_data["confidence"] < self.CONFIRM_THRESHOLD
+
+class ClientEventIndex(object):
+    """A secondary index from each client to their events, sorted by date.
+
+       A CalendarManager feeds it every event it downloads, so finding all
+       of a client's sessions is a lookup instead of a scan of the calendar.
+       If the ClientDirectory changes (a new client or billable name), the
+       index is rebuilt the next time it's read. A billability answer only
+       re-indexes the event it's about."""
+
+    def __init__(self, directory):
+        super(ClientEventIndex, self).__init__()
+        self.directory = directory
+        self.lock = threading.RLock()
+        self.events_by_key = {}
+        # client name -> (sorted list of start dates, list of events in the same order)
+        self.events_by_client = {}
+        # event identity -> (client name, start date) it was indexed under. A changed
+        # event may have moved, so the date of its new version can't be used to find it.
+        self.indexed_at = {}
+        self.version = directory.version
+        directory.event_indexes.append(self)
+
+    def add_events(self, events):
+        """Index newly downloaded events"""
+        with self.lock:
+            for event in events:
+                key = event.identity()
+                if key not in self.events_by_key:
+                    self.events_by_key[key] = event
+                    self.index_event(event)
+
+    def remove_events(self, events):
+        """Forget events that were deleted (or are about to be re-added)"""
+        with self.lock:
+            for event in events:
+                if self.events_by_key.pop(event.identity(), None) is not None:
+                    self.unindex_event(event)
+
+    def reindex_event(self, event):
+        """Match an already indexed event again, e.g. after it's been answered for"""
+        with self.lock:
+            indexed = self.events_by_key.get(event.identity())
+            if indexed is not None:
+                self.unindex_event(indexed)
+                self.index_event(indexed)
+
+    def index_event(self, event):
+        session_data = self.directory.is_event_billable(event)
+        if session_data is None:
+            return
+        name = session_data["client"].name
+        starts, events = self.events_by_client.setdefault(name, ([], []))
+        position = bisect_right(starts, event.date)
+        starts.insert(position, event.date)
+        events.insert(position, event)
+        self.indexed_at[event.identity()] = (name, event.date)
+
+    def unindex_event(self, event):
+        key = event.identity()
+        name, date = self.indexed_at.pop(key, (None, None))
+        if name is None:
+            return
+        starts, events = self.events_by_client[name]
+        lo = bisect_left(starts, date)
+        hi = bisect_right(starts, date)
+        for position in range(lo, hi):
+            if events[position].identity() == key:
+                del starts[position]
+                del events[position]
+                return
+
+    def rebuild_if_stale(self):
+        """Re-match every event if the directory has changed"""
+        if self.version == self.directory.version:
+            return
+        self.version = self.directory.version
+        self.events_by_client = {}
+        self.indexed_at = {}
+        for event in self.events_by_key.values():
+            self.index_event(event)
+
+    def events_for(self, client, first_day=None, last_day=None):
+        """Returns the sorted events of client (a Client or a name),
+           optionally only those on the days from first_day to last_day."""
+        name = client if isinstance(client, str) else client.name
+        with self.lock:
+            self.rebuild_if_stale()
+            starts, events = self.events_by_client.get(name, ([], []))
+            lo = 0 if first_day is None else bisect_left(starts, first_day)
+            hi = len(starts) if last_day is None else bisect_left(starts, last_day + timedelta(days=1))
+            return events[lo:hi]
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+import heapq, itertools, threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Job priorities: lower numbers run first
+INTERACTIVE = 0
+BACKGROUND = 10
+
+class JobCancelled(Exception):
+    """Raised inside a job that has been cancelled, to stop it early"""
+
+_local = threading.local()
+
+def current_job():
+    """The Job running on this thread, or None outside of a job"""
+    return getattr(_local, "job", None)
+
+@contextmanager
+def in_job(job):
+    """Run the body of a with block as part of job, on a thread of its own
+       (e.g. a pool of threads the job started), so current_job() is job
+       there too. job may be None."""
+    previous = current_job()
+    _local.job = job
+    try:
+        yield job
+    finally:
+        _local.job = previous
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def shared_pool(name, max_workers):
+    """The process-wide ThreadPoolExecutor called name, made the first time
+       it's asked for. Work that fans out inside a job (a practice query's
+       accounts, then each account's download chunks) uses one of these per
+       level, instead of a new pool per call, so the number of threads stays
+       bounded however many jobs fan out at once. Only ever wait on a pool
+       from outside it (a deeper level), or it can deadlock."""
+    with _pools_lock:
+        if name not in _pools:
+            _pools[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="AutoBiller " + name)
+        return _pools[name]
+
+class Job(object):
+    """One call of fn(*args, **kwargs), run by a JobScheduler.
+
+       Everyone who submitted the same key while the job was queued or
+       running shares it, as a subscriber. Cancelling only unsubscribes,
+       and the job is only really cancelled once nobody is left. A queued
+       job then never runs; a running one sees cancelled() become True,
+       and should stop by raising JobCancelled.
+
+       Callbacks are called on the worker thread. Qt code should go
+       through loginComponents.JobWatcher instead."""
+
+    def __init__(self, fn, args, kwargs, priority, key):
+        super(Job, self).__init__()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.key = key
+        self.state = "queued"
+        self.result = None
+        self.error = None
+        self.progress = (0, 0)
+        self.subscribers = 1
+        self.cancel_requested = False
+        self.done_callbacks = []
+        self.progress_callbacks = []
+        self.lock = threading.Lock()
+        self.done_event = threading.Event()
+
+    def cancel(self):
+        """Unsubscribe from the job. Returns True if that cancelled it."""
+        with self.lock:
+            if self.done_event.is_set():
+                return False
+            self.subscribers -= 1
+            if self.subscribers > 0:
+                return False
+            self.cancel_requested = True
+            return True
+
+    def cancelled(self):
+        return self.cancel_requested
+
+    def done(self):
+        return self.done_event.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job is done. Returns its result, or raises its error."""
+        if not self.done_event.wait(timeout):
+            raise TimeoutError("job {} is still {}".format(self.key, self.state))
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def add_done_callback(self, fn):
+        """Call fn(job) once the job is done (right away, if it already is)"""
+        with self.lock:
+            if not self.done_event.is_set():
+                self.done_callbacks.append(fn)
+                return
+        fn(self)
+
+    def add_progress_callback(self, fn):
+        """Call fn(done, total) whenever the job reports progress"""
+        with self.lock:
+            self.progress_callbacks.append(fn)
+
+    def report_progress(self, done, total):
+        self.progress = (done, total)
+        with self.lock:
+            callbacks = list(self.progress_callbacks)
+        for fn in callbacks:
+            self.call_back(fn, done, total)
+
+    def finish(self, state, result=None, error=None):
+        with self.lock:
+            self.state = state
+            self.result = result
+            self.error = error
+            callbacks = self.done_callbacks
+            self.done_callbacks = []
+            self.done_event.set()
+        for fn in callbacks:
+            self.call_back(fn, self)
+
+    @staticmethod
+    def call_back(fn, *args):
+        # A broken subscriber must never take the worker thread down with it
+        try:
+            fn(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def __repr__(self):
+        return "Job({}, {}, priority={})".format(self.key or self.fn.__name__, self.state, self.priority)
+
+class JobScheduler(object):
+    """A bounded pool of worker threads, shared by the whole app, running
+       Jobs highest priority (lowest number) first, and first come first
+       served within a priority.
+
+       Jobs submitted with a key are coalesced: while a job with that key
+       is queued or running, submitting the key again just subscribes to
+       it (raising its priority if the new submission is more urgent).
+       Workers are only started when there is work for them.
+
+       Jobs fan out on shared_pool()s, so with the defaults the AutoBiller
+       never runs more than 4 workers + 4 practice accounts + 8 download
+       threads at once."""
+
+    MAX_WORKERS = 4
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        super(JobScheduler, self).__init__()
+        self.max_workers = max_workers
+        self.condition = threading.Condition()
+        self.queue = []
+        self.order = itertools.count()
+        self.jobs_by_key = {}
+        self.workers = []
+        self.idle_workers = 0
+        self.stopped = False
+
+    def submit(self, fn, *args, priority=INTERACTIVE, key=None, **kwargs):
+        """Run fn(*args, **kwargs) on a worker thread. Returns its Job."""
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError("the scheduler has been shut down")
+            job = self.jobs_by_key.get(key) if key is not None else None
+            if job is not None:
+                with job.lock:
+                    if not job.cancel_requested:
+                        job.subscribers += 1
+                        if priority < job.priority and job.state == "queued":
+                            # Queue it again, more urgently. The old entry is skipped.
+                            job.priority = priority
+                            heapq.heappush(self.queue, (priority, next(self.order), job))
+                            self.condition.notify()
+                        return job
+
+            job = Job(fn, args, kwargs, priority, key)
+            if key is not None:
+                self.jobs_by_key[key] = job
+            heapq.heappush(self.queue, (priority, next(self.order), job))
+            if self.idle_workers == 0 and len(self.workers) < self.max_workers:
+                worker = threading.Thread(target=self.work, name="AutoBiller worker {}".format(len(self.workers) + 1), daemon=True)
+                self.workers.append(worker)
+                worker.start()
+            else:
+                self.condition.notify()
+            return job
+
+    def next_job(self):
+        """Wait for the most urgent queued job, or None once stopped"""
+        with self.condition:
+            while True:
+                while self.queue:
+                    priority, _, job = heapq.heappop(self.queue)
+                    if job.state != "queued" or priority != job.priority:
+                        # Already taken, or queued again at another priority
+                        continue
+                    if job.cancelled():
+                        self.forget(job)
+                        job.finish("cancelled", error=JobCancelled())
+                        continue
+                    job.state = "running"
+                    return job
+                if self.stopped:
+                    return None
+                self.idle_workers += 1
+                self.condition.wait()
+                self.idle_workers -= 1
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+            _local.job = job
+            try:
+                result = job.fn(*job.args, **job.kwargs)
+            except JobCancelled as error:
+                self.finish(job, "cancelled", error=error)
+            except Exception as error:
+                self.finish(job, "failed", error=error)
+            else:
+                self.finish(job, "done", result=result)
+            finally:
+                _local.job = None
+
+    def finish(self, job, state, result=None, error=None):
+        with self.condition:
+            self.forget(job)
+        job.finish(state, result, error)
+
+    def forget(self, job):
+        """Stop coalescing into job. Should only be called while holding self.condition."""
+        if job.key is not None and self.jobs_by_key.get(job.key) is job:
+            del self.jobs_by_key[job.key]
+
+    def shutdown(self, wait=True):
+        """Cancel everything queued, and stop the workers once they're free"""
+        with self.condition:
+            self.stopped = True
+            for _, _, job in self.queue:
+                job.cancel_requested = True
+            self.condition.notify_all()
+            workers = list(self.workers)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+scheduler = JobScheduler()
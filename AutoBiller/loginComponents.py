@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import Qt, QSize, QObject, pyqtSignal
+from PyQt5.QtGui import QIcon, QMovie
+
+from jobScheduler import scheduler, BACKGROUND
+from sessionStore import SessionStore, resume_last_session
+from utils import abs_path
+# Only what the login window needs is imported here, so it can be shown
+# before pyicloud and the calendar modules are loaded.
+
+class LoginWindow(QMainWindow):
+    """The window shown at startup, holding a LoginWidget.
+       Once the user has logged in, on_login(icloud, username, session) is called.
+       If the last account's saved session is still trusted, that happens by itself."""
+
+    def __init__(self, on_login, parent=None):
+        super().__init__(parent)
+        self.on_login = on_login
+        self.icloud = None
+        self.username = None
+        self.session = None
+        self.logged_in = False
+
+        self.setWindowIcon(QIcon(abs_path('resources/icon.png')))
+        self.setMinimumSize(500, 300)
+        self.setWindowTitle("AutoBiller")
+
+        self.setCentralWidget(LoginWidget(parent=self))
+
+    def resume_session(self):
+        """Try to log back in to the last account, in the background"""
+        self.statusBar().showMessage("Resuming your last session...")
+        job = scheduler.submit(resume_last_session, priority=BACKGROUND, key=("resume session",))
+        self.resume_watcher = JobWatcher(job, self.session_resumed, parent=self)
+
+    def session_resumed(self, job):
+        self.statusBar().clearMessage()
+        if job.state != "done" or job.result is None or self.logged_in:
+            # Nothing to resume (or the user was quicker): the login form is still there
+            return
+        self.icloud, self.session = job.result
+        self.username = self.session.username
+        self.go_to_main()
+
+    def go_to_main(self):
+        """Hand the logged in account over to the main scene"""
+        if self.logged_in:
+            return
+        self.logged_in = True
+        self.session.remember_last_login()
+        self.on_login(self.icloud, self.username, self.session)
+
+def offer_to_save_password(parent, username, password):
+    """Ask whether to keep password in the system keyring (as pyicloud's own
+       command line does), so an expired session can be logged back in to
+       without asking. Nothing is asked if it's already there."""
+    from sessionStore import saved_password, save_password
+
+    if not password or saved_password(username) == password:
+        return
+    reply = QMessageBox.question(parent,
+                                'Save Password',
+                                "Save the password of {} in the system keyring? Then the AutoBiller "
+                                "can log back in by itself when iCloud expires your session.".format(username),
+                                QMessageBox.Yes, QMessageBox.No)
+    if reply == QMessageBox.Yes:
+        save_password(username, password)
+
+class LoginConfirmationPopup(QDialog):
+    """The popup used to confirm login information for 2-factor authentification"""
+
+    def __init__(self, icloud_acct, parent=None):
+        super().__init__(parent)
+        self.icloud_acct = icloud_acct
+
+        # Set up layout
+        confirmation_layout = QVBoxLayout()
+
+        label1 = QLabel("<p>Login requires two-factor authentification. Please select a device to receive your confirmation code.</p>")
+        confirmation_layout.addWidget(label1, alignment=Qt.AlignCenter)
+
+        devices = icloud_acct.trusted_devices
+        devices_list = QListWidget()
+        for d in devices:
+            QListWidgetItem("SMS to %s" % d.get('phoneNumber'), parent=devices_list)
+        devices_list.setCurrentRow(0)
+        confirmation_layout.addWidget(devices_list, alignment=Qt.AlignCenter)
+
+        code_button = QPushButton("Send Code")
+        code_button.clicked.connect(lambda x: self.send_code(devices[devices_list.currentRow()]))
+        confirmation_layout.addWidget(code_button, alignment=Qt.AlignCenter)
+
+        self.setLayout(confirmation_layout)
+        # Layout finished
+
+
+    def send_code(self, device):
+        """Send verification code to trusted device for 2FA"""
+        if not self.icloud_acct.send_verification_code(device):
+            warning = QMessageBox.warning(self,
+                                    'Failed to send code',
+                                    "Failed to send verification code. Please try again.")
+            self.close()
+
+        form = QFormLayout()
+        form.addRow('Confirmation code:', QLineEdit())
+        self.layout().addLayout(form)
+
+        confirmation_button = QPushButton("Confirm Code")
+        confirmation_button.clicked.connect(lambda: self.verify_code(device,
+                                                                        form.itemAt(1).widget().text()
+                                                                        )
+                                            )
+        confirmation_button.setDefault(True)
+        self.layout().addWidget(confirmation_button, alignment=Qt.AlignCenter)
+
+
+
+    def verify_code(self, device, code):
+        """Verify confirmation code for 2FA"""
+        if not self.icloud_acct.validate_verification_code(device, code):
+            warning = QMessageBox.warning(self,
+                                    'Invalid Code',
+                                    "The verification code you entered was not valid! Try logging in again!")
+        self.close()
+
+class LoginWidget(QWidget):
+    """The opening scene, for logging in to iCloud."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        # Set up layout
+        v_layout = QVBoxLayout()
+
+        label1 = QLabel("<h1>Welcome!</h1>")
+        v_layout.addWidget(label1, alignment=Qt.AlignCenter)
+
+        label2 = QLabel("<p>Login to your iCloud account to continue:<p>")
+        v_layout.addWidget(label2, alignment=Qt.AlignCenter)
+
+        # Username & Password info
+        form = QFormLayout()
+        password_field = QLineEdit()
+        form.addRow('Username:', QLineEdit())
+        form.addRow('Password:', password_field)
+        password_field.returnPressed.connect(lambda: self.login(
+                                                    form.itemAt(1).widget().text(),
+                                                    form.itemAt(3).widget().text(),
+                                                    )
+                                            )
+        v_layout.addLayout(form)
+
+        # Login Button (inside a HiddenLoaderStackedWidget)
+        login_button = QPushButton("Login")
+        hidden_loader_with_login_button = HiddenLoaderStackedWidget(login_button)
+        self.loader = hidden_loader_with_login_button
+        login_button.clicked.connect(lambda: self.login(
+                                                    form.itemAt(1).widget().text(),
+                                                    form.itemAt(3).widget().text(),
+                                                    )
+                                    )
+        login_button.clicked.connect(self.loader.start_loading)
+        password_field.returnPressed.connect(self.loader.start_loading)
+        v_layout.addWidget(hidden_loader_with_login_button, alignment=Qt.AlignCenter)
+
+        self.setLayout(v_layout)
+        # Layout finished
+
+    def login(self, username, password):
+        """Log the user into their iCloud account."""
+
+        # Handle the login on the shared scheduler, so clicking twice only logs in once
+        job = scheduler.submit(self.login_target_fn, username, password, key=("login", username))
+        self.login_watcher = JobWatcher(job, lambda job: self.finished(job, username, password), parent=self)
+
+    def login_target_fn(self, username, password):
+        """
+        Attempts to log in to the icloud acct matching the username and password,
+        resuming its saved session if there is one.
+        Returns True if the acct requires 2FA, False otherwise.
+        """
+        from sessionStore import login
+
+        me, session = login(username, password)
+        self.parent().icloud = me
+        self.parent().username = username
+        self.parent().session = session
+        if me.requires_2fa:
+            return True
+        return False
+
+    def finished(self, job, username, password):
+        """When finished, confirm 2FA if needed, then navigate away from login scene."""
+        self.loader.stop_loading()
+        if job.state != "done":
+            QMessageBox.warning(self, 'Login Failed', "Couldn't log in to iCloud: {}".format(job.error))
+            return
+        offer_to_save_password(self, username, password)
+        if job.result:
+            self.start_confirmation_popup()
+            # Keep the trust token, so the next launch doesn't need 2FA
+            self.parent().session.save()
+        self.parent().go_to_main()
+
+    def start_confirmation_popup(self):
+        """Open a LoginConfirmationPopup for 2FA"""
+        icloud = self.parent().icloud
+        confirmation_dialog = LoginConfirmationPopup(icloud_acct=icloud)
+        confirmation_dialog.exec_()
+
+class HiddenLoaderStackedWidget(QStackedWidget):
+    """A QStackedWidget that always contains a loading .gif underneath."""
+
+    def __init__(self, widget_on_top, parent=None, size=None):
+        super().__init__(parent)
+        self.widget_on_top = widget_on_top
+
+        # Initialize the loader gif
+        self.gif = QMovie(abs_path("resources/loading.gif"))
+        if size:
+            self.gif.setScaledSize(QSize(int(414*size), int(233*size)))
+        self.label = QLabel()
+        self.label.setMovie(self.gif)
+
+        self.addWidget(self.label)
+        self.addWidget(self.widget_on_top)
+        self.setCurrentWidget(self.widget_on_top)
+
+    def start_loading(self):
+        self.setCurrentWidget(self.label)
+        self.label.show()
+        self.gif.start()
+
+    def stop_loading(self):
+        self.gif.stop()
+        self.setCurrentWidget(self.widget_on_top)
+
+class JobWatcher(QObject):
+    """Brings a Job's progress and result back to the GUI thread.
+       Widgets subscribe to a job through one of these, and get
+       on_finished(job) and on_progress(done, total) as Qt slots."""
+    finished = pyqtSignal(object)
+    progress = pyqtSignal(int, int)
+
+    def __init__(self, job, on_finished, on_progress=None, parent=None):
+        super().__init__(parent)
+        self.job = job
+        self.finished.connect(on_finished)
+        if on_progress:
+            self.progress.connect(on_progress)
+
+        # Signals emitted from the worker thread are queued for the GUI thread
+        job.add_progress_callback(self.progress.emit)
+        job.add_done_callback(self.finished.emit)
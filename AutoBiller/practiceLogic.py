@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import heapq, threading
+from collections import OrderedDict
+from calendarLogic import *
+from jobScheduler import current_job, in_job, shared_pool, JobCancelled
+
+class PracticeManager(object):
+    """The calendars of every clinician in a group practice.
+
+       Each logged in account is a shard: a CalendarManager of its own, with
+       its own backend, cache and prefetcher. A practice-wide query loads the
+       same days from every shard in parallel, then puts the (already sorted)
+       events of all the shards together with one k-way merge."""
+
+    # Accounts loaded at once, by every practice-wide query together (their
+    # chunks are then downloaded on the CalendarManagers' shared pool)
+    MAX_WORKERS = 4
+
+    def __init__(self):
+        super(PracticeManager, self).__init__()
+        self.lock = threading.Lock()
+        self.managers = OrderedDict()
+        self.names = {}
+
+    def __len__(self):
+        return len(self.managers)
+
+    def add_account(self, username, calendar_manager, name=None):
+        """Add (or replace) the shard of the account username, shown as name"""
+        with self.lock:
+            self.managers[username] = calendar_manager
+            self.names[username] = name or username.split("@")[0]
+        return calendar_manager
+
+    def remove_account(self, username):
+        with self.lock:
+            self.managers.pop(username, None)
+            self.names.pop(username, None)
+
+    def accounts(self):
+        """The (username, CalendarManager) of every shard, in the order they were added"""
+        with self.lock:
+            return list(self.managers.items())
+
+    def name(self, username):
+        return self.names.get(username, username)
+
+    def load_date_range(self, date_range, sync=False, record=True):
+        """Load date_range from every account in parallel.
+           If sync is True, already-downloaded days are checked for changes.
+           Unless record is False, each shard's prefetcher sees the query.
+
+           RETURNS: a list of (username, sorted events within date_range), one per account"""
+        job = current_job()
+        def load(account):
+            username, calendar_manager = account
+            # Let the shards see if the job running this has been cancelled
+            with in_job(job):
+                try:
+                    if sync:
+                        calendar_manager.sync_date_range(date_range)
+                    return username, calendar_manager.add_date_range(DateRange(date_range.start, date_range.end), record)
+                except JobCancelled:
+                    raise
+                except Exception as error:
+                    raise RuntimeError("{}: {}".format(self.name(username), error)) from error
+
+        accounts = self.accounts()
+        if len(accounts) <= 1:
+            return [load(account) for account in accounts]
+        return list(shared_pool("practice", self.MAX_WORKERS).map(load, accounts))
+
+    def practice_events(self, date_range, sync=False, record=True):
+        """Every event within date_range, from every account.
+
+           RETURNS: a list of (clinician name, event) sorted by date. Events at
+                    the same time stay in the order their accounts were added."""
+        streams = [[(self.name(username), event) for event in events]
+                   for username, events in self.load_date_range(date_range, sync, record)]
+        return list(heapq.merge(*streams, key=lambda tagged: tagged[1].date))
+
+    def __repr__(self):
+        return "PracticeManager({})".format(", ".join(self.name(username) for username, _ in self.accounts()))
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import json, os, shutil, tempfile, threading, warnings
+
+from utils import get_account_path, get_data_path
+# pyicloud, keyring and cryptography are only imported when they're needed,
+# so the login window doesn't wait for them.
+
+KEYRING_SERVICE = "AutoBiller"
+
+# What keep_alive needs from the user, if anything
+NEEDS_PASSWORD = "password"
+NEEDS_2FA = "2fa"
+
+_cipher_lock = threading.Lock()
+_cipher = []
+
+# Every SessionStore with a plain copy of its session, to be closed on quit
+_open_stores = set()
+
+def session_cipher():
+    """The Fernet cipher session files are encrypted with, or None if they
+       can't be (there's no system keyring to keep the key in).
+       The key is made the first time, and kept in the system keyring."""
+    with _cipher_lock:
+        if not _cipher:
+            try:
+                import keyring
+                from cryptography.fernet import Fernet
+
+                key = keyring.get_password(KEYRING_SERVICE, "session-key")
+                if key is None:
+                    key = Fernet.generate_key().decode("ascii")
+                    keyring.set_password(KEYRING_SERVICE, "session-key", key)
+                _cipher.append(Fernet(key.encode("ascii")))
+            except Exception:
+                # Sessions are then not kept between launches at all (see write_bundle)
+                _cipher.append(None)
+        return _cipher[0]
+
+def read_bundle(path):
+    """The dict saved at path by write_bundle, or {} if there isn't one, or it
+       can't be decrypted (e.g. it isn't encrypted, or the key has been lost)"""
+    cipher = session_cipher()
+    if cipher is None:
+        return {}
+    try:
+        with open(path, "rb") as bundle_file:
+            data = cipher.decrypt(bundle_file.read())
+        return json.loads(data.decode("utf-8"))
+    except Exception:
+        return {}
+
+def can_save_sessions():
+    """Whether logins can be kept between launches (see session_cipher)"""
+    return session_cipher() is not None
+
+def write_bundle(path, contents):
+    """Save the dict contents to path, encrypted, and only readable by this user.
+       Without a cipher nothing is saved (and an old file at path is removed),
+       since the tokens would otherwise be on disk in plain text.
+
+       RETURNS: whether contents were saved"""
+    cipher = session_cipher()
+    if cipher is None:
+        warnings.warn("There's no system keyring to encrypt saved iCloud sessions with, so logins aren't kept between launches")
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+    data = cipher.encrypt(json.dumps(contents).encode("utf-8"))
+    temp_path = path + ".tmp"
+    descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, "wb") as bundle_file:
+        bundle_file.write(data)
+    os.replace(temp_path, path)
+    return True
+
+class SessionStore(object):
+    """Keeps an iCloud login (pyicloud's session token, trust token and
+       cookies) between launches, so a trusted session is simply resumed
+       instead of logging in, and going through 2FA, again.
+
+       pyicloud reads and writes those as plain files in a cookie directory.
+       While logged in, they live in a private temporary directory; save()
+       bundles them into one encrypted file in the AutoBiller's data folder,
+       and close() removes the plain copies."""
+
+    LAST_LOGIN = "session-last.bin"
+
+    def __init__(self, username, path):
+        super(SessionStore, self).__init__()
+        self.username = username
+        self.path = path
+        self.directory = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_account(cls, username):
+        """The saved session of the given iCloud account"""
+        return cls(username, get_account_path(username, "session", "bin"))
+
+    def cookie_directory(self):
+        """The directory to give pyicloud as its cookie_directory, with the saved session in it"""
+        with self.lock:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="autobiller-session-")
+                _open_stores.add(self)
+                for name, text in read_bundle(self.path).get("files", {}).items():
+                    # Only ever write plain file names into the directory
+                    with open(os.path.join(self.directory, os.path.basename(name)), "w", encoding="utf-8") as f:
+                        f.write(text)
+            return self.directory
+
+    def has_session(self):
+        """Whether a session token was saved, so there's a session to try resuming"""
+        files = read_bundle(self.path).get("files", {})
+        return any(name.endswith(".session") and "session_token" in text for name, text in files.items())
+
+    def save(self):
+        """Save what pyicloud has written to the cookie directory"""
+        with self.lock:
+            if self.directory is None:
+                return
+            files = {}
+            for name in os.listdir(self.directory):
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    files[name] = f.read()
+            write_bundle(self.path, {"files": files})
+
+    def remember_last_login(self):
+        """Make this the account resumed on the next launch"""
+        write_bundle(os.path.join(get_data_path(), self.LAST_LOGIN), {"username": self.username})
+
+    def close(self):
+        """Save the session, then remove the plain copy of it"""
+        self.save()
+        with self.lock:
+            if self.directory is not None:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.directory = None
+            _open_stores.discard(self)
+
+    @classmethod
+    def last_username(cls):
+        """The account that last logged in on this computer, or None"""
+        return read_bundle(os.path.join(get_data_path(), cls.LAST_LOGIN)).get("username")
+
+def saved_password(username):
+    """The account's password from the system keyring (where pyicloud looks for it), or None"""
+    try:
+        from pyicloud.utils import get_password_from_keyring
+        return get_password_from_keyring(username)
+    except Exception:
+        return None
+
+def save_password(username, password):
+    """Keep the account's password in the system keyring, so an expired session
+       can be logged back in to without asking. Does nothing without a keyring.
+       Only call this once the user has agreed to it."""
+    try:
+        from pyicloud.utils import store_password_in_keyring
+        store_password_in_keyring(username, password)
+    except Exception:
+        pass
+
+def use_password(icloud, password):
+    """Log in to icloud with password from now on (e.g. after the user re-entered it)"""
+    icloud.user["password"] = password
+
+def close_all_sessions():
+    """Save and close every open session, e.g. when the AutoBiller quits"""
+    for store in list(_open_stores):
+        try:
+            store.close()
+        except OSError:
+            pass
+
+def login(username, password=None, store=None):
+    """Log in to iCloud, resuming the account's saved session if it's still valid.
+       Apple is only asked for 2FA (icloud.requires_2fa) when the saved session
+       has really expired, or was never trusted.
+
+       RETURNS: a tuple (PyiCloudService, SessionStore)"""
+    from pyicloud import PyiCloudService
+
+    store = store or SessionStore.for_account(username)
+    icloud = PyiCloudService(username, password, cookie_directory=store.cookie_directory())
+    store.save()
+    return icloud, store
+
+def resume_last_session():
+    """Log back in to the last account, without asking for its password, if
+       its saved session is still trusted. RETURNS: (PyiCloudService, SessionStore), or None."""
+    username = SessionStore.last_username()
+    if not username:
+        return None
+    store = SessionStore.for_account(username)
+    if not store.has_session():
+        return None
+    try:
+        # With a valid session token the password is never sent. It's only
+        # needed to log back in once the token expires (see keep_alive).
+        icloud, store = login(username, saved_password(username) or "", store)
+    except Exception:
+        store.close()
+        return None
+    if icloud.requires_2fa:
+        store.close()
+        return None
+    return icloud, store
+
+def keep_alive(icloud, store):
+    """Validate the session token, which keeps the session from expiring. If it
+       has expired anyway, log in again with the password pyicloud already has.
+
+       RETURNS: NEEDS_PASSWORD if that password didn't work (or there wasn't one),
+                NEEDS_2FA if the new login needs 2FA, or None if all is well"""
+    from pyicloud.exceptions import PyiCloudFailedLoginException
+
+    try:
+        icloud.authenticate()
+    except PyiCloudFailedLoginException:
+        return NEEDS_PASSWORD
+    store.save()
+    return NEEDS_2FA if icloud.requires_2fa else None
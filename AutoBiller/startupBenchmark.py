@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import argparse, json, os, re, subprocess, sys, time
+
+from benchmarks import compare
+
+# Run from the AutoBiller folder:
+#     python startupBenchmark.py [--save FILE] [--compare [FILE]]
+#
+# Reports, in "name value unit" lines:
+#  - the import time of the modules loaded before the login window, and of
+#    the modules the main scene needs (from python -X importtime)
+#  - the wall-clock time from launching the AutoBiller to its first window
+# Each is the best of REPEATS fresh processes. Measurements that can't be
+# taken (e.g. without PyQt5) are left out. resources/startup_benchmarks.json
+# is the baseline --compare uses by default.
+
+REPEATS = 3
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(HERE, "resources", "startup_benchmarks.json")
+
+def import_time_ms(module):
+    """The total (cumulative) import time of module in a fresh interpreter"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=HERE, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)$", line)
+        if match and match.group(2) == module:
+            return int(match.group(1)) / 1000
+    return None
+
+def time_to_first_window_ms():
+    """Launch the AutoBiller and wait for it to report its first window"""
+    env = dict(os.environ, AUTOBILLER_STARTUP_BENCHMARK="1")
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "__main__.py"], cwd=HERE, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    for line in process.stdout:
+        if line.strip() == "first window shown":
+            elapsed = (time.perf_counter() - start) * 1000
+            process.wait()
+            return elapsed
+    process.wait()
+    return None
+
+def best_of(measure, repeats):
+    """The lowest of repeats measurements, or None if it couldn't be measured"""
+    values = [value for value in (measure() for _ in range(repeats)) if value is not None]
+    return min(values) if values else None
+
+def run(repeats=REPEATS):
+    results = {
+        "startup.import.loginComponents": best_of(lambda: import_time_ms("loginComponents"), repeats),
+        "startup.import.uiComponents": best_of(lambda: import_time_ms("uiComponents"), repeats),
+        "startup.import.cli": best_of(lambda: import_time_ms("cli"), repeats),
+        "startup.time_to_first_window": best_of(time_to_first_window_ms, repeats),
+    }
+    return {name: value for name, value in results.items() if value is not None}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Time the AutoBiller's imports and its first window")
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--save", metavar="FILE", help="Save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", nargs="?", const=BASELINE,
+                        help="Fail if slower than a saved baseline (default: {})".format(BASELINE))
+    args = parser.parse_args(argv)
+
+    results = run(args.repeats)
+    for name, value in results.items():
+        print("{} {:.1f} ms".format(name, value))
+
+    if args.save:
+        with open(args.save, "w+") as f:
+            json.dump({name: round(value, 1) for name, value in results.items()}, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            if not compare(results, json.load(f)):
+                return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
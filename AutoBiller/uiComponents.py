@@ -1,20 +1,29 @@
 # -*- coding: utf-8 -*-
 
 from PyQt5.QtWidgets import *
-from PyQt5.QtCore import Qt, QDateTime, QSize, QObject, QThread, pyqtSignal
+from PyQt5.QtCore import Qt, QTimer, QDateTime, QSize, QObject, pyqtSignal, QAbstractTableModel, QModelIndex
 from PyQt5.QtGui import QIcon, QMovie, QPixmap, QPalette, QColor
 
-from pyicloud import PyiCloudService
 from time import sleep
 
+from loginComponents import *
 from clientLogic import *
 from calendarLogic import *
+from calendarCache import *
+from practiceLogic import *
+from billingModel import *
+from instrumentation import metrics
+from jobScheduler import scheduler, INTERACTIVE, BACKGROUND
+from sessionStore import can_save_sessions, keep_alive, use_password, NEEDS_PASSWORD, NEEDS_2FA
 from utils import *
 # TODO: change to AutoBiller.* for distribution
 
 class MainScene(QMainWindow):
     """The main scene of the AutoBiller app"""
 
+    # How often every logged in iCloud session is kept alive
+    KEEP_ALIVE_MINUTES = 10
+
     def __init__(self, client_directory, calendar_manager, parent=None):
         super().__init__(parent)
 
@@ -22,13 +31,21 @@ class MainScene(QMainWindow):
         self._createToolBar()
         self._createStatusBar()
 
-        self.setWindowIcon(QIcon('resources/icon.png'))
+        self.setWindowIcon(QIcon(abs_path('resources/icon.png')))
         self.setMinimumSize(500, 300)
         self.setWindowTitle("AutoBiller")
 
         self.icloud = None
         self.client_directory = client_directory
         self.calendar_manager = calendar_manager
+        # Every clinician's calendar, for practice-wide reports
+        self.practice = PracticeManager()
+        # username -> (PyiCloudService, SessionStore) of every logged in account
+        self.sessions = {}
+        self.keep_alive_watchers = {}
+        self.keep_alive_timer = QTimer(self)
+        self.keep_alive_timer.timeout.connect(self.keep_sessions_alive)
+        self.keep_alive_timer.start(self.KEEP_ALIVE_MINUTES * 60 * 1000)
 
         nq = NewQueryWidget(parent=self)
         self.navigable_pages = [nq]
@@ -45,6 +62,9 @@ class MainScene(QMainWindow):
 
         new_actions = menubar.addMenu("Settings")
         new_actions.addAction("Change Fees", self.change_fees)
+        new_actions.addAction("Add Clinician", self.add_clinician)
+        new_actions.addAction("Forget Billing Answers", self.forget_billing_answers)
+        new_actions.addAction("Diagnostics", self.show_diagnostics)
 
         new_actions = menubar.addMenu("New")
         new_actions.addAction("New Query", lambda: self.nav(0))
@@ -95,6 +115,18 @@ class MainScene(QMainWindow):
         # Resize window
         self.resize(QSize(500, 300))
 
+    def set_account(self, icloud, username, session=None):
+        """Use the logged in iCloud account, and its local caches"""
+        self.icloud = icloud
+        if session is not None:
+            self.sessions[username] = (icloud, session)
+            if not can_save_sessions():
+                self.status.showMessage("No system keyring: you'll have to log in again next time")
+        self.calendar_manager.use_backend(ICloudBackend(icloud))
+        self.calendar_manager.use_store(EventStore.for_account(username))
+        self.client_directory.use_decisions(DecisionCache.for_account(username))
+        self.practice.add_account(username, self.calendar_manager)
+
     def go_to_main(self):
         """Sets the QStackedWidget as the central widget"""
         self.setCentralWidget(self.stacked_widget)
@@ -103,11 +135,55 @@ class MainScene(QMainWindow):
         action = self.toolbar.findChildren(QAction)[page_num+2]
         action.setText(new_name)
 
-    def new_bill_by_day(self, date):
-        """Asks the attached calendar manager to bill one day"""
+    def new_bill_by_day(self, date, sync=False):
+        """Asks the attached calendar manager to bill one day.
+           If sync is True, already-downloaded events are checked for changes."""
         assert type(date) == datetime
 
-        return self.calendar_manager.add_one_day(date)
+        return self.calendar_manager.add_one_day(date, sync)
+
+    def new_bill_by_range(self, start, end, sync=False):
+        """Asks the attached calendar manager for every event from start to end"""
+        assert type(start) == datetime
+        assert type(end) == datetime
+
+        date_range = DateRange(start, end)
+        if sync:
+            self.calendar_manager.sync_date_range(date_range)
+        return self.calendar_manager.add_date_range(date_range)
+
+    def new_bill_by_client(self, client_name, start, end, sync=False):
+        """Asks the attached calendar manager for client_name's events from start to end.
+           client_name must already be a client (new ones are added on the GUI thread first)."""
+        assert type(start) == datetime
+        assert type(end) == datetime
+
+        if client_name not in self.client_directory.clients_by_name:
+            raise ValueError("{} isn't a client".format(client_name))
+        self.new_bill_by_range(start, end, sync)
+        return self.calendar_manager.client_index.events_for(client_name, start, end)
+
+    def new_bill_by_practice(self, start, end, sync=False):
+        """Asks every clinician's calendar for their events from start to end, at once.
+           Returns a list of (clinician, event), sorted by date."""
+        assert type(start) == datetime
+        assert type(end) == datetime
+
+        return self.practice.practice_events(DateRange(start, end), sync)
+
+    def new_display_query_by_practice_widget(self, name, tagged_events, group_by="clinician"):
+        """Create a new DisplayQueryByPracticeWidget, then add it to pages and go there"""
+        display = DisplayQueryByPracticeWidget(name=name, events=tagged_events, group_by=group_by, parent=self)
+        self.add_page(display)
+        self.stacked_widget.setCurrentWidget(display)
+        return display
+
+    def new_display_query_by_range_widget(self, name, events, group_by="day"):
+        """Create a new DisplayQueryByRangeWidget, then add it to pages and go there"""
+        display = DisplayQueryByRangeWidget(name=name, events=events, group_by=group_by, parent=self)
+        self.add_page(display)
+        self.stacked_widget.setCurrentWidget(display)
+        return display
 
     def new_display_query_by_day_widget(self, name, events):
         """Create a new DisplayQueryByDayWidget, then add it to pages and go there"""
@@ -138,6 +214,162 @@ class MainScene(QMainWindow):
         fee_popup = ChangeFeesPopup(self)
         fee_popup.exec_()
 
+    def forget_billing_answers(self):
+        """Forget every yes/no billability answer, after asking"""
+        reply = QMessageBox.question(self,
+                                    'Forget Billing Answers',
+                                    "Forget every billable / not billable answer you've given? "
+                                    "Sessions will be matched to clients by name again.",
+                                    QMessageBox.Yes, QMessageBox.No)
+        if reply == QMessageBox.Yes:
+            self.client_directory.forget_decisions()
+            self.status.showMessage("Forgot every billing answer")
+
+    def add_clinician(self):
+        """Open a popup to log in to another clinician's iCloud account"""
+        account_popup = AddClinicianPopup(self)
+        account_popup.exec_()
+
+    def add_practice_account(self, icloud, username, session=None):
+        """Add a logged in clinician's calendar to the practice, with its own cache"""
+        if session is not None:
+            self.sessions[username] = (icloud, session)
+        calendar_manager = CalendarManager(parent=self, store=EventStore.for_account(username),
+                                           backend=ICloudBackend(icloud))
+        self.practice.add_account(username, calendar_manager)
+        self.status.showMessage("Added {} to the practice".format(self.practice.name(username)))
+
+    def keep_sessions_alive(self):
+        """Keep every logged in iCloud session from expiring, in the background"""
+        for username in self.sessions:
+            self.keep_session_alive(username)
+
+    def keep_session_alive(self, username):
+        icloud, session = self.sessions[username]
+        job = scheduler.submit(keep_alive, icloud, session, priority=BACKGROUND, key=("keep alive", username))
+        self.keep_alive_watchers[username] = JobWatcher(job, lambda job: self.session_kept_alive(username, job), parent=self)
+
+    def session_kept_alive(self, username, job):
+        """Expired sessions are logged back in to by themselves. Only bother
+           the user if that needs their password (it isn't in the keyring,
+           or has changed) or 2FA."""
+        icloud, session = self.sessions[username]
+        if job.state != "done":
+            # Most likely offline: try again on the next tick
+            self.status.showMessage("Couldn't reach iCloud for {}: {}".format(username, job.error))
+        elif job.result == NEEDS_PASSWORD:
+            password, ok = QInputDialog.getText(self, "iCloud Password",
+                                                "Your iCloud session for {} has expired. Please enter its password:".format(username),
+                                                QLineEdit.Password)
+            if ok and password:
+                use_password(icloud, password)
+                offer_to_save_password(self, username, password)
+                self.keep_session_alive(username)
+        elif job.result == NEEDS_2FA:
+            confirmation_dialog = LoginConfirmationPopup(icloud_acct=icloud, parent=self)
+            confirmation_dialog.exec_()
+            session.save()
+
+    def show_diagnostics(self):
+        """Open (or bring back) the diagnostics panel, next to the main scene"""
+        if getattr(self, "diagnostics", None) is None:
+            self.diagnostics = DiagnosticsPopup(self.calendar_manager, parent=self)
+        self.diagnostics.show()
+        self.diagnostics.raise_()
+
+class DiagnosticsPopup(QDialog):
+    """A live view of the instrumentation: cache hit rate, bytes downloaded,
+       and the latency of each stage of a query."""
+
+    REFRESH_MS = 1000
+    COLUMNS = ["Stage", "Count", "Mean (ms)", "Max (ms)", "Last (ms)"]
+
+    def __init__(self, calendar_manager, parent=None):
+        super().__init__(parent)
+        self.calendar_manager = calendar_manager
+        self.setWindowTitle("Diagnostics")
+        self.setModal(False)
+
+        # Set up layout
+        layout = QVBoxLayout()
+
+        self.summary = QLabel()
+        layout.addWidget(self.summary)
+
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.verticalHeader().hide()
+        layout.addWidget(self.table)
+
+        buttons = QHBoxLayout()
+        reset_btn = QPushButton("Reset")
+        reset_btn.clicked.connect(self.reset)
+        buttons.addWidget(reset_btn)
+        close_btn = QPushButton("Close")
+        close_btn.clicked.connect(self.close)
+        buttons.addWidget(close_btn)
+        layout.addLayout(buttons)
+
+        self.setLayout(layout)
+        # Layout finished
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(lambda: self.refresh() if self.isVisible() else None)
+        self.timer.start(self.REFRESH_MS)
+        self.refresh()
+        self.resize(560, 360)
+
+    def refresh(self):
+        """Show the latest numbers"""
+        snapshot = metrics.snapshot()
+        counters = snapshot["counters"]
+        prefetch = self.calendar_manager.prefetcher.stats()
+        self.summary.setText(
+            "Cache hit rate: {:.0%} ({} hits, {} misses)<br>"
+            "Downloaded: {:.1f} KB in {} requests ({} retried)<br>"
+            "Prefetched: {} days in {} prefetches".format(
+                metrics.hit_rate("calendar.cache"),
+                counters.get("calendar.cache.hits", 0), counters.get("calendar.cache.misses", 0),
+                counters.get("calendar.download.bytes", 0) / 1024, counters.get("calendar.download.chunks", 0),
+                counters.get("calendar.download.errors", 0),
+                prefetch["prefetched_days"], prefetch["prefetches"]))
+
+        timers = sorted(snapshot["timers"].items())
+        self.table.setRowCount(len(timers))
+        for row, (name, timer) in enumerate(timers):
+            values = [name, str(timer["count"])] + ["{:.1f}".format(timer[key]) for key in ("mean_ms", "max_ms", "last_ms")]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.table.setItem(row, column, item)
+        self.table.resizeColumnsToContents()
+
+    def reset(self):
+        metrics.reset()
+        self.refresh()
+
+class AddClinicianPopup(QDialog):
+    """The popup for logging in to another clinician's iCloud account,
+       so their sessions show up in practice-wide reports."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.icloud = None
+        self.username = None
+        self.session = None
+        self.setWindowTitle("Add Clinician")
+
+        layout = QVBoxLayout()
+        layout.addWidget(LoginWidget(parent=self))
+        self.setLayout(layout)
+
+    def go_to_main(self):
+        """Called by the LoginWidget once the clinician has logged in"""
+        self.parent().add_practice_account(self.icloud, self.username, self.session)
+        self.close()
+
 class ChangeFeesPopup(QDialog):
     """The popup used to change stored fees"""
 
@@ -164,7 +396,7 @@ class ChangeFeesPopup(QDialog):
         for i in range(8):
             field = fees.itemAt(2*i + 1).widget()
             type = ChangeFeesPopup.types_in_order[i]
-            field.setPlaceholderText(str(fee_by_cpt_code[type]))
+            field.setPlaceholderText(str(get_fees()[type]))
 
         layout.addLayout(fees)
 
@@ -186,8 +418,6 @@ class ChangeFeesPopup(QDialog):
         if new_fees:
             # Update the fees in all relevant places
             write_fees(new_fees)
-            for k in fee_by_cpt_code.keys():
-                fee_by_cpt_code[k] = new_fees[k]
 
             confirm = QMessageBox.information(self,
                                     'Fee Change',
@@ -210,145 +440,10 @@ class ChangeFeesPopup(QDialog):
                                             "At least one of your fees is not a number!")
                     return False
             else:
-                new_fees[type] = fee_by_cpt_code[type]
+                new_fees[type] = get_fees()[type]
 
         return new_fees
 
-class LoginConfirmationPopup(QDialog):
-    """The popup used to confirm login information for 2-factor authentification"""
-
-    def __init__(self, icloud_acct, parent=None):
-        super().__init__(parent)
-        self.icloud_acct = icloud_acct
-
-        # Set up layout
-        confirmation_layout = QVBoxLayout()
-
-        label1 = QLabel("<p>Login requires two-factor authentification. Please select a device to receive your confirmation code.</p>")
-        confirmation_layout.addWidget(label1, alignment=Qt.AlignCenter)
-
-        devices = icloud_acct.trusted_devices
-        devices_list = QListWidget()
-        for d in devices:
-            QListWidgetItem("SMS to %s" % d.get('phoneNumber'), parent=devices_list)
-        devices_list.setCurrentRow(0)
-        confirmation_layout.addWidget(devices_list, alignment=Qt.AlignCenter)
-
-        code_button = QPushButton("Send Code")
-        code_button.clicked.connect(lambda x: self.send_code(devices[devices_list.currentRow()]))
-        confirmation_layout.addWidget(code_button, alignment=Qt.AlignCenter)
-
-        self.setLayout(confirmation_layout)
-        # Layout finished
-
-
-    def send_code(self, device):
-        """Send verification code to trusted device for 2FA"""
-        if not self.icloud_acct.send_verification_code(device):
-            warning = QMessageBox.warning(self,
-                                    'Failed to send code',
-                                    "Failed to send verification code. Please try again.")
-            self.close()
-
-        form = QFormLayout()
-        form.addRow('Confirmation code:', QLineEdit())
-        self.layout().addLayout(form)
-
-        confirmation_button = QPushButton("Confirm Code")
-        confirmation_button.clicked.connect(lambda: self.verify_code(device,
-                                                                        form.itemAt(1).widget().text()
-                                                                        )
-                                            )
-        confirmation_button.setDefault(True)
-        self.layout().addWidget(confirmation_button, alignment=Qt.AlignCenter)
-
-
-
-    def verify_code(self, device, code):
-        """Verify confirmation code for 2FA"""
-        if not self.icloud_acct.validate_verification_code(device, code):
-            warning = QMessageBox.warning(self,
-                                    'Invalid Code',
-                                    "The verification code you entered was not valid! Try logging in again!")
-        self.close()
-
-class LoginWidget(QWidget):
-    """The opening scene, for logging in to iCloud."""
-
-    def __init__(self, parent=None):
-        super().__init__(parent)
-
-        # Set up layout
-        v_layout = QVBoxLayout()
-
-        label1 = QLabel("<h1>Welcome!</h1>")
-        v_layout.addWidget(label1, alignment=Qt.AlignCenter)
-
-        label2 = QLabel("<p>Login to your iCloud account to continue:<p>")
-        v_layout.addWidget(label2, alignment=Qt.AlignCenter)
-
-        # Username & Password info
-        form = QFormLayout()
-        password_field = QLineEdit()
-        form.addRow('Username:', QLineEdit())
-        form.addRow('Password:', password_field)
-        password_field.returnPressed.connect(lambda: self.login(
-                                                    form.itemAt(1).widget().text(),
-                                                    form.itemAt(3).widget().text(),
-                                                    )
-                                            )
-        v_layout.addLayout(form)
-
-        # Login Button (inside a HiddenLoaderStackedWidget)
-        login_button = QPushButton("Login")
-        hidden_loader_with_login_button = HiddenLoaderStackedWidget(login_button)
-        self.loader = hidden_loader_with_login_button
-        login_button.clicked.connect(lambda: self.login(
-                                                    form.itemAt(1).widget().text(),
-                                                    form.itemAt(3).widget().text(),
-                                                    )
-                                    )
-        login_button.clicked.connect(self.loader.start_loading)
-        password_field.returnPressed.connect(self.loader.start_loading)
-        v_layout.addWidget(hidden_loader_with_login_button, alignment=Qt.AlignCenter)
-
-        self.setLayout(v_layout)
-        # Layout finished
-
-    def login(self, username, password):
-        """Log the user into their iCloud account."""
-
-        #Handle the login in a worker QThread
-        target_fn = self.login_target_fn
-        args = (username, password)
-        on_close_fn = self.finished
-        gui_fn = self.start_confirmation_popup
-
-        self.login_thread = ThreadedTask(target_fn, args, on_close_fn, gui_fn)
-        self.login_thread.start()
-
-    def login_target_fn(self, username, password):
-        """
-        Attempts to log in to the icloud acct matching the username and password.
-        Returns True if the acct requires 2FA, False otherwise.
-        """
-        me = PyiCloudService(username, password)
-        self.parent().icloud = me
-        if me.requires_2fa:
-            return True
-        return False
-
-    def finished(self):
-        """When finished, navigate away from login scene."""
-        self.loader.stop_loading()
-        self.parent().go_to_main()
-
-    def start_confirmation_popup(self):
-        """Open a LoginConfirmationPopup for 2FA"""
-        icloud = self.parent().icloud
-        confirmation_dialog = LoginConfirmationPopup(icloud_acct=icloud)
-        confirmation_dialog.exec_()
-
 class NewQueryWidget(QWidget):
     """The scene where a user decides whether to bill by client or by day."""
 
@@ -372,8 +467,16 @@ class NewQueryWidget(QWidget):
         bill_by_day_button = QPushButton("Bill by Day")
         bill_by_day_button.clicked.connect(self.init_bill_by_day)
 
+        bill_by_range_button = QPushButton("Bill by Range")
+        bill_by_range_button.clicked.connect(self.init_bill_by_range)
+
+        bill_by_practice_button = QPushButton("Bill Practice")
+        bill_by_practice_button.clicked.connect(self.init_bill_by_practice)
+
         buttons.addButton(bill_by_client_button, 0)
         buttons.addButton(bill_by_day_button, 0)
+        buttons.addButton(bill_by_range_button, 0)
+        buttons.addButton(bill_by_practice_button, 0)
 
         v_layout.addWidget(buttons, alignment=Qt.AlignCenter)
 
@@ -386,15 +489,46 @@ class NewQueryWidget(QWidget):
         day_query = DayQueryPopup(parent=self)
         day_query.exec_()
 
-    def bill_by_day(self, date):
+    def bill_by_day(self, date, sync=False):
         """Ask the main scene to bill the given day."""
         assert type(date) == datetime
-        return self.parent().parent().new_bill_by_day(date)
+        return self.parent().parent().new_bill_by_day(date, sync)
+
+    def init_bill_by_range(self):
+        """Open a RangeQueryPopup and get the days to be billed."""
+
+        range_query = RangeQueryPopup(parent=self)
+        range_query.exec_()
+
+    def bill_by_range(self, start, end, sync=False):
+        """Ask the main scene to bill every day from start to end."""
+        assert type(start) == datetime
+        assert type(end) == datetime
+        return self.parent().parent().new_bill_by_range(start, end, sync)
+
+    def init_bill_by_practice(self):
+        """Open a PracticeQueryPopup and get the days to bill every clinician for."""
+
+        practice_query = PracticeQueryPopup(parent=self)
+        practice_query.exec_()
+
+    def bill_by_practice(self, start, end, sync=False):
+        """Ask the main scene to bill every clinician's sessions from start to end."""
+        assert type(start) == datetime
+        assert type(end) == datetime
+        return self.parent().parent().new_bill_by_practice(start, end, sync)
 
     def init_bill_by_client(self):
         """Open a ClientQueryPopup and get the client to be billed."""
-        # TODO: Implement bill by client
-        pass
+
+        client_query = ClientQueryPopup(parent=self)
+        client_query.exec_()
+
+    def bill_by_client(self, client_name, start, end, sync=False):
+        """Ask the main scene to bill one client's sessions from start to end."""
+        assert type(start) == datetime
+        assert type(end) == datetime
+        return self.parent().parent().new_bill_by_client(client_name, start, end, sync)
 
 class BillableConfirmationPopup(QDialog):
     """docstring for BillableConfirmationPopup."""
@@ -434,7 +568,53 @@ class BillableConfirmationPopup(QDialog):
         self.client.add_unbillable_event(self.calendar_event)
         self.close()
 
-class DayQueryPopup(QDialog):
+class QueryPopup(QDialog):
+    """The base of the popups that download calendar data for a report.
+       The download runs as a job on the shared scheduler; the popup only
+       subscribes to it. Closing the popup while it loads cancels the job
+       (unless another popup is waiting on the same one)."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.job = None
+
+    def main_scene(self):
+        return self.parent().window()
+
+    def start_query(self, fn, *args, key=None):
+        """Run fn(*args) as an interactive job, then call query_finished"""
+        self.job = scheduler.submit(fn, *args, priority=INTERACTIVE, key=key)
+        self.watcher = JobWatcher(self.job, self.query_finished, self.show_progress, parent=self)
+
+    def show_progress(self, done, total):
+        self.main_scene().status.showMessage("Downloading from iCloud... ({}/{})".format(done, total))
+
+    def query_finished(self, job):
+        """Stop the loading gif, then show the report (or what went wrong) and close."""
+        self.loader.stop_loading()
+        self.main_scene().status.clearMessage()
+        if job.state == "failed":
+            QMessageBox.warning(self, 'Download Failed', "Couldn't get your calendar: {}".format(job.error))
+            return
+        if job.state == "done":
+            self.gui_fn(job.result)
+        self.close()
+
+    def cancel_query(self):
+        if self.job is not None and not self.job.done():
+            self.job.cancel()
+            self.loader.stop_loading()
+            self.main_scene().status.clearMessage()
+
+    def reject(self):
+        self.cancel_query()
+        super().reject()
+
+    def closeEvent(self, event):
+        self.cancel_query()
+        super().closeEvent(event)
+
+class DayQueryPopup(QueryPopup):
     """The popup for choosing a day to bill."""
 
     def __init__(self, parent=None):
@@ -451,6 +631,10 @@ class DayQueryPopup(QDialog):
         self.date_picker = date_picker
         layout.addWidget(date_picker, alignment=Qt.AlignCenter)
 
+        sync_checkbox = QCheckBox("Check iCloud for changes")
+        self.sync_checkbox = sync_checkbox
+        layout.addWidget(sync_checkbox, alignment=Qt.AlignCenter)
+
         confirm_button = QPushButton("Bill")
         hidden_loader_with_confirm_button = HiddenLoaderStackedWidget(confirm_button, size=.6)
         self.loader = hidden_loader_with_confirm_button
@@ -467,107 +651,318 @@ class DayQueryPopup(QDialog):
         and begins downloading calendar data.
         """
 
-        # Handle the login in a worker QThread
         date = self.date_picker.date()
         self.date = datetime(date.year(), date.month(), date.day())
+        sync = self.sync_checkbox.isChecked()
 
-        target_fn = self.bill_by_day_target_fn
-        args = (self.date,)
-        on_close_fn = self.finished
+        # Tell the NewQueryWindow to bill one day, on a worker thread
+        self.start_query(self.parent().bill_by_day, self.date, sync, key=("day", self.date, sync))
 
+    def gui_fn(self, events_of_day):
+        """Tell the main scene to make a DisplayQueryByDayWidget based on the events_of_day data."""
+        self.main_scene().new_display_query_by_day_widget(
+                                            self.date.strftime("%m/%d/%Y"),
+                                            events_of_day
+                                            )
 
-        self.login_thread = ThreadedTask(target_fn, args, on_close_fn, self.gui_fn)
-        self.login_thread.start()
+class RangeQueryPopup(QueryPopup):
+    """The popup for choosing a range of days to bill in one report."""
 
-    def bill_by_day_target_fn(self, date):
-        """Tell the NewQueryWindow to bill one day"""
-        self.events_of_day = self.parent().bill_by_day(date)
-        return True
+    GROUP_BY = ["day", "client"]
 
-    def finished(self):
-        """Stop the loading gif before closing."""
-        self.loader.stop_loading()
-        self.close()
+    def __init__(self, parent=None):
+        super().__init__(parent)
 
-    def gui_fn(self):
-        """Tell the main scene to make a DisplayQueryByDayWidget based on the events_of_day data."""
-        self.parent().parent().parent().new_display_query_by_day_widget(
-                                            self.date.strftime("%m/%d/%Y"),
-                                            self.events_of_day
+        # Set up layout
+        layout = QVBoxLayout()
+
+        label1 = QLabel("<p>Please choose the days you'd like to bill for:</p>")
+        layout.addWidget(label1, alignment=Qt.AlignCenter)
+
+        form = QFormLayout()
+        start_picker = QDateEdit(calendarPopup=True)
+        start_picker.setDateTime(QDateTime.currentDateTime().addMonths(-1))
+        end_picker = QDateEdit(calendarPopup=True)
+        end_picker.setDateTime(QDateTime.currentDateTime())
+        group_by_dropdown = QComboBox()
+        group_by_dropdown.addItems(self.GROUP_BY)
+        form.addRow("From:", start_picker)
+        form.addRow("To:", end_picker)
+        form.addRow("Group by:", group_by_dropdown)
+        self.start_picker = start_picker
+        self.end_picker = end_picker
+        self.group_by_dropdown = group_by_dropdown
+        layout.addLayout(form)
+
+        sync_checkbox = QCheckBox("Check iCloud for changes")
+        self.sync_checkbox = sync_checkbox
+        layout.addWidget(sync_checkbox, alignment=Qt.AlignCenter)
+
+        confirm_button = QPushButton("Bill")
+        hidden_loader_with_confirm_button = HiddenLoaderStackedWidget(confirm_button, size=.6)
+        self.loader = hidden_loader_with_confirm_button
+        confirm_button.clicked.connect(self.confirm_range)
+        confirm_button.clicked.connect(self.loader.start_loading)
+        layout.addWidget(hidden_loader_with_confirm_button, alignment=Qt.AlignCenter)
+
+        self.setLayout(layout)
+        # Layout finished
+
+    def confirm_range(self):
+        """
+        A function that confirms the selected days
+        and begins downloading calendar data.
+        """
+
+        start = self.start_picker.date()
+        end = self.end_picker.date()
+        self.start = datetime(start.year(), start.month(), start.day())
+        self.end = datetime(end.year(), end.month(), end.day())
+        if self.end < self.start:
+            self.start, self.end = self.end, self.start
+        self.group_by = self.group_by_dropdown.currentText()
+        sync = self.sync_checkbox.isChecked()
+
+        # Tell the NewQueryWindow to bill the range, on a worker thread
+        self.start_query(self.parent().bill_by_range, self.start, self.end, sync,
+                         key=("range", self.start, self.end, sync))
+
+    def gui_fn(self, events_of_range):
+        """Tell the main scene to make a DisplayQueryByRangeWidget based on the events_of_range data."""
+        self.main_scene().new_display_query_by_range_widget(
+                                            "{} - {}".format(self.start.strftime("%m/%d/%Y"), self.end.strftime("%m/%d/%Y")),
+                                            events_of_range,
+                                            self.group_by
+                                            )
+
+class PracticeQueryPopup(RangeQueryPopup):
+    """The popup for choosing a range of days to bill every clinician for."""
+
+    GROUP_BY = ["clinician", "day", "client"]
+
+    def confirm_range(self):
+        """Confirm the selected days, then download every clinician's calendar at once."""
+        start = self.start_picker.date()
+        end = self.end_picker.date()
+        self.start = datetime(start.year(), start.month(), start.day())
+        self.end = datetime(end.year(), end.month(), end.day())
+        if self.end < self.start:
+            self.start, self.end = self.end, self.start
+        self.group_by = self.group_by_dropdown.currentText()
+        sync = self.sync_checkbox.isChecked()
+
+        self.start_query(self.parent().bill_by_practice, self.start, self.end, sync,
+                         key=("practice", self.start, self.end, sync))
+
+    def gui_fn(self, tagged_events):
+        """Tell the main scene to make a DisplayQueryByPracticeWidget from every clinician's events."""
+        self.main_scene().new_display_query_by_practice_widget(
+                                            "Practice {} - {}".format(self.start.strftime("%m/%d/%Y"), self.end.strftime("%m/%d/%Y")),
+                                            tagged_events,
+                                            self.group_by
+                                            )
+
+class ClientQueryPopup(QueryPopup):
+    """The popup for choosing a client, and the days to bill them for."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+
+        # Set up layout
+        layout = QVBoxLayout()
+
+        label1 = QLabel("<p>Please choose the client you'd like to bill for:</p>")
+        layout.addWidget(label1, alignment=Qt.AlignCenter)
+
+        form = QFormLayout()
+        client_dropdown = QComboBox()
+        client_dropdown.setEditable(True)
+        client_directory = self.parent().parent().parent().client_directory
+        client_dropdown.addItems([client.name for client in client_directory.clients])
+        today = QDateTime.currentDateTime()
+        start_picker = QDateEdit(calendarPopup=True)
+        start_picker.setDateTime(today.addDays(1 - today.date().dayOfYear()))
+        end_picker = QDateEdit(calendarPopup=True)
+        end_picker.setDateTime(today)
+        form.addRow("Client:", client_dropdown)
+        form.addRow("From:", start_picker)
+        form.addRow("To:", end_picker)
+        self.client_dropdown = client_dropdown
+        self.start_picker = start_picker
+        self.end_picker = end_picker
+        layout.addLayout(form)
+
+        sync_checkbox = QCheckBox("Check iCloud for changes")
+        self.sync_checkbox = sync_checkbox
+        layout.addWidget(sync_checkbox, alignment=Qt.AlignCenter)
+
+        confirm_button = QPushButton("Bill")
+        hidden_loader_with_confirm_button = HiddenLoaderStackedWidget(confirm_button, size=.6)
+        self.loader = hidden_loader_with_confirm_button
+        confirm_button.clicked.connect(self.confirm_client)
+        confirm_button.clicked.connect(self.loader.start_loading)
+        layout.addWidget(hidden_loader_with_confirm_button, alignment=Qt.AlignCenter)
+
+        self.setLayout(layout)
+        # Layout finished
+
+    def confirm_client(self):
+        """
+        A function that confirms the selected client and days
+        and begins downloading calendar data.
+        """
+
+        start = self.start_picker.date()
+        end = self.end_picker.date()
+        self.start = datetime(start.year(), start.month(), start.day())
+        self.end = datetime(end.year(), end.month(), end.day())
+        if self.end < self.start:
+            self.start, self.end = self.end, self.start
+        self.client_name = self.client_dropdown.currentText().strip()
+        if not self.client_name:
+            self.loader.stop_loading()
+            return
+        client_directory = self.main_scene().client_directory
+        if self.client_name not in client_directory.clients_by_name:
+            # A typo shouldn't become a client, so a new name is only added if the user says so
+            reply = QMessageBox.question(self,
+                                        'New Client',
+                                        "{} isn't one of your clients yet. Add them?".format(self.client_name),
+                                        QMessageBox.Yes, QMessageBox.No)
+            if reply != QMessageBox.Yes:
+                self.loader.stop_loading()
+                return
+            client_directory.add_client(self.client_name)
+
+        sync = self.sync_checkbox.isChecked()
+
+        # Tell the NewQueryWindow to bill the client, on a worker thread
+        self.start_query(self.parent().bill_by_client, self.client_name, self.start, self.end, sync,
+                         key=("client", self.client_name, self.start, self.end, sync))
+
+    def gui_fn(self, events_of_client):
+        """Tell the main scene to make a DisplayQueryByClientWidget based on the events_of_client data."""
+        self.main_scene().new_display_query_by_client_widget(
+                                            "{} ({} - {})".format(self.client_name,
+                                                                  self.start.strftime("%m/%d/%Y"),
+                                                                  self.end.strftime("%m/%d/%Y")),
+                                            events_of_client
                                             )
 
-class HiddenLoaderStackedWidget(QStackedWidget):
-    """A QStackedWidget that always contains a loading .gif underneath."""
+class BillingTableModel(QAbstractTableModel):
+    """A Qt table model over a list of BillingRows.
+       The view only asks for the rows it's painting, and editors are
+       only created by the delegates while a cell is being edited."""
 
-    def __init__(self, widget_on_top, parent=None, size=None):
+    def __init__(self, rows, header=BILLING_HEADER, parent=None):
         super().__init__(parent)
-        self.widget_on_top = widget_on_top
-
-        # Initialize the loader gif
-        self.gif = QMovie("resources/loading.gif")
-        if size:
-            self.gif.setScaledSize(QSize(int(414*size), int(233*size)))
-        self.label = QLabel()
-        self.label.setMovie(self.gif)
-
-        self.addWidget(self.label)
-        self.addWidget(self.widget_on_top)
-        self.setCurrentWidget(self.widget_on_top)
-
-    def start_loading(self):
-        self.setCurrentWidget(self.label)
-        self.label.show()
-        self.gif.start()
-
-    def stop_loading(self):
-        self.gif.stop()
-        self.setCurrentWidget(self.widget_on_top)
-
-class ThreadedTask(QObject):
-    """A signle class for singular threaded tasks."""
-    finished = pyqtSignal()
-    update = pyqtSignal()
-
-    def __init__(self, target_fn, args, on_close_fn, gui_fn=None):
-        super().__init__()
-        self.target_fn = target_fn
-        self.args = args
-        self.on_close_fn = on_close_fn
-        self.gui_fn = gui_fn
-
-        self.thread = QThread()
-        self.moveToThread(self.thread)
-
-        # Connect signals and slot
-        self.thread.started.connect(self.run)
-        self.thread.finished.connect(self.thread.deleteLater)
-        self.thread.finished.connect(self.on_close_fn)
-        self.finished.connect(self.thread.quit)
-        self.finished.connect(self.deleteLater)
-
-        if self.gui_fn:
-            self.update.connect(self.gui_fn)
-
-    def run(self):
-        # Do what you came to do
-        if self.target_fn(*self.args):
-            # Id the target_fn ever returns yes,
-            self.update.emit()
-        self.finished.emit()
-
-    def start(self):
-        self.thread.start()
+        self.rows = rows
+        self.header = header
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.header)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.header[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        column = index.column()
+        if column == 0:
+            if role == Qt.CheckStateRole:
+                return Qt.Checked if row.checked else Qt.Unchecked
+            return None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return row.value(self.header[column])
+        if role == Qt.TextAlignmentRole:
+            return int(Qt.AlignCenter)
+        return None
+
+    def flags(self, index):
+        flags = Qt.ItemIsEnabled | Qt.ItemIsSelectable
+        if index.column() == 0:
+            flags |= Qt.ItemIsUserCheckable
+        elif self.rows[index.row()].checked and self.header[index.column()] in EDITABLE_COLUMNS:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid():
+            return False
+        row = self.rows[index.row()]
+        if index.column() == 0 and role == Qt.CheckStateRole:
+            if value == Qt.Checked:
+                row.check()
+            else:
+                row.uncheck()
+        elif role == Qt.EditRole and row.checked and self.header[index.column()] in EDITABLE_COLUMNS:
+            row.set_field(self.header[index.column()], value)
+        else:
+            return False
+        self.row_changed(index.row())
+        return True
+
+    def row_changed(self, i):
+        """Tell the view that row i needs repainting"""
+        self.dataChanged.emit(self.index(i, 0), self.index(i, len(self.header) - 1))
+
+class ComboBoxDelegate(QStyledItemDelegate):
+    """Edits a cell with a QComboBox, which only exists while editing."""
+
+    def __init__(self, items_fn, editable=False, parent=None):
+        super().__init__(parent)
+        self.items_fn = items_fn
+        self.editable = editable
+
+    def createEditor(self, parent, option, index):
+        editor = QComboBox(parent)
+        editor.addItems(self.items_fn())
+        editor.setEditable(self.editable)
+        if not self.editable:
+            # Commit as soon as a new item is picked
+            editor.activated.connect(lambda _: self.commitData.emit(editor))
+        return editor
+
+    def setEditorData(self, editor, index):
+        text = index.data(Qt.EditRole)
+        position = editor.findText(text)
+        if position >= 0:
+            editor.setCurrentIndex(position)
+        elif self.editable:
+            editor.setEditText(text)
+
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.currentText(), Qt.EditRole)
+
+    def updateEditorGeometry(self, editor, option, index):
+        editor.setGeometry(option.rect)
 
 class DisplayQueryWidget(QWidget):
     """A generic scene to display a finished iCloud query"""
 
+    SIZING_SAMPLE = 100
+    MAX_HEIGHT = 700
+
     def __init__(self, name=None, events=None, data=None, parent=None):
         super().__init__(parent)
         self.name = name
         self.events = events
         self.data = data
         self.header = None
-        self.types_in_order = ["90791", "96152", "90832", "90834", "90837", "90853", "90847", "90839"]
+        self.types_in_order = CPT_CODES
+        self.rows = self.make_rows(events)
+        self.model = None
 
         # Get page number
         self.page_num = None
@@ -580,19 +975,73 @@ class DisplayQueryWidget(QWidget):
         self.title = QLabel("<h2>Bill: {}</h2>".format(self.name))
         self.layout.addWidget(self.title, alignment=Qt.AlignCenter)
 
-        self.table = QTableWidget()
-        self.table.setRowCount(len(events))
+        self.table = QTableView()
         self.table.setSizeAdjustPolicy(
             QAbstractScrollArea.AdjustToContents)
+        # Only measure a sample of the rows when sizing columns
+        self.table.horizontalHeader().setResizeContentsPrecision(self.SIZING_SAMPLE)
         self.layout.addWidget(self.table, alignment=Qt.AlignCenter)
 
-        self.export_as_csv_btn = QPushButton("Export as .csv")
-        self.export_as_csv_btn.clicked.connect(self.export_as_csv)
-        self.layout.addWidget(self.export_as_csv_btn, alignment=Qt.AlignCenter)
+        export_layout = QHBoxLayout()
+        self.export_format_dropdown = QComboBox()
+        self.export_format_dropdown.addItems(["Excel (.csv)", "Excel (.xlsx)", "CMS-1500 (.txt)"])
+        export_layout.addWidget(self.export_format_dropdown)
+        self.export_btn = QPushButton("Export")
+        self.export_btn.clicked.connect(lambda: self.export(EXPORT_FORMATS[self.export_format_dropdown.currentIndex()]))
+        export_layout.addWidget(self.export_btn)
+        self.layout.addLayout(export_layout)
 
         self.setLayout(self.layout)
         # Layout finished
 
+    def make_rows(self, events):
+        """One BillingRow per event"""
+        return [BillingRow(event) for event in events]
+
+    def set_model(self, model):
+        """Show the given BillingTableModel in the table"""
+        self.model = model
+        self.table.setModel(model)
+
+    def match_rows(self):
+        """Check every row whose event is a session. Low-confidence matches
+           are only billed if the user agrees, and the user is only asked
+           once for each distinct event title."""
+        client_directory = self.parent().client_directory
+        answers_by_title = {}
+        # Every answer is saved once, at the end
+        with client_directory.batch_decisions():
+            for row in self.rows:
+                session_data = client_directory.is_event_billable(row.event)
+                if session_data and client_directory.needs_confirmation(session_data):
+                    client = session_data["client"]
+                    if row.event.title in answers_by_title:
+                        client.change_event_billability(row.event, answers_by_title[row.event.title])
+                    else:
+                        confirmation = BillableConfirmationPopup(client, row.event, parent=self)
+                        confirmation.exec_()
+                        answers_by_title[row.event.title] = client.relevant_calendar_events_by_billability.get(row.event.identity(), False)
+                    session_data = client_directory.is_event_billable(row.event)
+                if session_data:
+                    row.check(**session_data)
+
+    def add_delegates(self):
+        """Edit the name and CPT columns with dropdowns"""
+        client_directory = self.parent().client_directory
+        self.name_delegate = ComboBoxDelegate(
+            lambda: ["Group"] + [client.name for client in client_directory.clients],
+            editable=True, parent=self)
+        self.cpt_delegate = ComboBoxDelegate(lambda: self.types_in_order, parent=self)
+        self.table.setItemDelegateForColumn(self.header.index("Event / Client"), self.name_delegate)
+        self.table.setItemDelegateForColumn(self.header.index("CPT"), self.cpt_delegate)
+
+    def fit_window(self, window):
+        """Resize window around the table, up to MAX_HEIGHT"""
+        self.table.resizeColumnsToContents()
+        size = self.table.sizeHint() + QSize(100, 190)
+        size.setHeight(min(size.height(), self.MAX_HEIGHT))
+        window.resize(size)
+
     def rename(self, new_name):
         """Rename this page to new_name."""
         self.name = new_name
@@ -601,22 +1050,24 @@ class DisplayQueryWidget(QWidget):
 
     def export_as_csv(self):
         """Export the information contained in the checked elements of this page to a .csv"""
+        self.export("csv")
+
+    def export(self, export_format):
+        """Export the checked rows of this page on a worker thread"""
         filename = "BillingReport: " + self.name.replace("/","-") + "({})".format(datetime.today().strftime("%m.%d.%Y"))
-        fieldnames = self.header[1:]
-        checked_rows = []
-        for i in range(self.table.rowCount()):
-            checked = self.table.cellWidget(i, 0).findChildren(QCheckBox)[0].checkState()
-            if checked == Qt.Checked:
-                row_dict = {}
-                for j, field in enumerate(fieldnames):
-                    widget = self.table.cellWidget(i,j+1)
-                    if widget:
-                        row_dict[field] = widget.findChild(QComboBox).currentText()
-                    else:
-                        row_dict[field] = self.table.item(i, j+1).text()
-                checked_rows.append(row_dict)
-        self.parent().parent().status.showMessage("File Saved to Downloads!")
-        download_csv_file(filename, fieldnames, checked_rows)
+        self.export_btn.setEnabled(False)
+
+        path = download_path(filename, EXPORT_EXTENSIONS[export_format])
+        job = scheduler.submit(export_rows, self.rows, self.header[1:], path, export_format, key=("export", path))
+        self.export_watcher = JobWatcher(job, self.export_finished, parent=self)
+
+    def export_finished(self, job):
+        """Let the user know the export is done"""
+        self.export_btn.setEnabled(True)
+        if job.state != "done":
+            QMessageBox.warning(self, 'Export Failed', str(job.error))
+        else:
+            self.parent().parent().status.showMessage("File Saved to Downloads!")
 
 class DisplayQueryByDayWidget(DisplayQueryWidget):
     """A scene to display a finished iCloud query of a particular day."""
@@ -625,135 +1076,71 @@ class DisplayQueryByDayWidget(DisplayQueryWidget):
         super().__init__(name, events, data, parent)
 
         # Set up table
-        self.header = ["Billable?","Event / Client","CPT","Insurance","Payment","Billing Fee"]
-        self.table.setColumnCount(len(self.header))
-        self.table.setHorizontalHeaderLabels(self.header)
-        self.is_event_billable = self.parent().client_directory.is_event_billable
-        self.client_by_row = {}
+        self.header = BILLING_HEADER
+        self.client_directory = self.parent().client_directory
+        self.is_event_billable = self.client_directory.is_event_billable
 
-        for i, event in enumerate(self.events):
-            # Add the evnts to the table, then check if they are events.
-            self.add_to_table(i, event)
+        # Matching may stop to ask the user, so it's timed apart from the table
+        with metrics.timer("ui.match_rows", rows=len(self.rows)):
+            self.match_rows()
+        with metrics.timer("ui.build_day_table", rows=len(self.rows)):
+            self.set_model(BillingTableModel(self.rows, self.header, parent=self))
+            self.add_delegates()
 
-            session_data = self.is_event_billable(event)
-            if session_data:
-                self.table.cellWidget(i, 0).findChild(QCheckBox).setCheckState(2)
-                self.set_row_info(i, **session_data)
+            self.fit_window(self.parent())
 
-        self.table.resizeColumnsToContents()
-        self.table.resizeRowsToContents()
-        self.parent().resize(self.table.sizeHint() + QSize(100, 190))
-
-    def add_to_table(self, i, event):
-        """Add the given non-session event to row i"""
-        checkbox_item = QWidget()
-        checkbox = QCheckBox()
-        c_layout = QHBoxLayout(checkbox_item)
-        c_layout.addWidget(checkbox, alignment=Qt.AlignCenter)
-        checkbox_item.setLayout(c_layout)
-        self.table.setCellWidget(i, 0, checkbox_item)
-        checkbox.stateChanged.connect(lambda state: self.checkbox_toggled(state, i))
-
-        title = QTableWidgetItem(event.title)
-        title.setTextAlignment(Qt.AlignCenter)
-        self.table.removeCellWidget(i, 1)
-        self.table.setItem(i, 1, title)
-        title.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-
-        cpt = QTableWidgetItem("---")
-        cpt.setTextAlignment(Qt.AlignCenter)
-        self.table.removeCellWidget(i, 2)
-        self.table.setItem(i, 2, cpt)
-        cpt.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-
-        insurance = QTableWidgetItem("---")
-        insurance.setTextAlignment(Qt.AlignCenter)
-        self.table.setItem(i, 3, insurance)
-        insurance.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-
-        copay = QTableWidgetItem("---")
-        copay.setTextAlignment(Qt.AlignCenter)
-        self.table.setItem(i, 4, copay)
-        copay.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-
-        fee = QTableWidgetItem("---")
-        fee.setTextAlignment(Qt.AlignCenter)
-        self.table.setItem(i, 5, fee)
-        fee.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-
-    def set_row_info(self, row, name, cpt="", insurance="", fee=""):
+    def set_row_info(self, row, name, cpt="", insurance="", fee="", client=None, confidence=1.0):
         """Set the information at a given row to the new session info"""
-        name_box = self.table.cellWidget(row, 1).findChild(QComboBox)
-        name_box.addItem(name)
-        name_box.setCurrentIndex(name_box.count() - 1)
-        if cpt:
-            # Set the cpt to the appropriate value
-            index = self.types_in_order.index(cpt)
-            self.table.cellWidget(row, 2).findChild(QComboBox).setCurrentIndex(index)
-        self.table.item(row, 3).setText(insurance)
+        self.rows[row].check(name, cpt, insurance, fee, client, confidence)
+        self.model.row_changed(row)
 
+class DisplayQueryByRangeWidget(DisplayQueryWidget):
+    """A scene to display one report for every event in a range of days,
+       grouped by day or by client, with totals for each group."""
 
-    def checkbox_toggled(self, new_state, i):
-        """
-        Activates when the check mark at row i is toggled.
-        A new_state of 2 means the mark is checked, 0 for unchecked.
-        This transforms the event row into the editable version if checked, or vice versa.
+    HEADER = RANGE_BILLING_HEADER
 
-        RETURNS: none
-        """
-        if new_state: # The checkbox was toggled on
-
-            title = QWidget()
-            title_dropdown = QComboBox()
-            d_layout = QHBoxLayout(title)
-            d_layout.addWidget(title_dropdown, alignment=Qt.AlignCenter)
-            title.setLayout(d_layout)
-            self.table.setCellWidget(i, 1, title)
-
-            title_dropdown.setEditable(True)
-            title_dropdown.setInsertPolicy(QComboBox.InsertAtBottom)
-            title_dropdown.setSizeAdjustPolicy(QComboBox.AdjustToContents)
-
-
-            title_dropdown.addItem("Group")
-            title_dropdown.insertSeparator(1)
-
-            title_dropdown.setCurrentIndex(-1)
-            title_dropdown.setCurrentText("Client")
-            # TODO: implement defaults from the ClientDirectory
-            #title_dropdown.currentTextChanged.connect() # TODO
-
-            cpt = QWidget()
-            cpt_dropdown = QComboBox()
-            d_layout = QHBoxLayout(cpt)
-            d_layout.addWidget(cpt_dropdown, alignment=Qt.AlignCenter)
-            cpt.setLayout(d_layout)
-            self.table.setCellWidget(i, 2, cpt)
-
-            cpt_dropdown.addItem("90791")
-            cpt_dropdown.addItem("96152")
-            cpt_dropdown.addItem("90832")
-            cpt_dropdown.addItem("90834")
-            cpt_dropdown.addItem("90837")
-            cpt_dropdown.addItem("90853")
-            cpt_dropdown.addItem("90847")
-            cpt_dropdown.addItem("90839")
-
-            # When the cpt code is changed, change the corresponding fee
-            cpt_dropdown.currentIndexChanged.connect(lambda index: self.table.item(i, 5).setText(str(fee_by_cpt_code[self.types_in_order[index]])))
-            cpt_dropdown.setCurrentIndex(3)
-            self.table.item(i, 5).setText(str(fee_by_cpt_code[self.types_in_order[3]]))
-
-            # Allow user to edit insurance & Payment
-            self.table.item(i, 3).setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable)
-            self.table.item(i, 4).setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable)
-            self.table.item(i, 3).setText("")
-            self.table.item(i, 4).setText("")
-
-        else: # The checkbox was toggled off
-            self.add_to_table(i, self.events[i])
-
-        # Resize table and window:
-        self.table.resizeColumnsToContents()
-        self.table.resizeRowsToContents()
-        self.parent().parent().resize(self.table.sizeHint() + QSize(100, 190))
+    def __init__(self, name=None, events=None, group_by="day", parent=None):
+        super().__init__(name, events, None, parent)
+        self.group_by = group_by
+
+        # Set up table
+        self.header = self.HEADER
+        with metrics.timer("ui.match_rows", rows=len(self.rows)):
+            self.match_rows()
+        with metrics.timer("ui.build_range_table", rows=len(self.rows)):
+            sort_rows(self.rows, self.group_by)
+            self.set_model(BillingTableModel(self.rows, self.header, parent=self))
+            self.add_delegates()
+
+        # Totals go between the table and the export button
+        self.totals = QLabel()
+        self.layout.insertWidget(2, self.totals, alignment=Qt.AlignCenter)
+        self.model.dataChanged.connect(self.update_totals)
+        self.update_totals()
+
+        self.fit_window(self.parent())
+
+    def update_totals(self):
+        """Show the number of billed sessions and the fees for each group"""
+        lines = ["<table><tr><th>{}</th><th>Sessions</th><th>Fees</th></tr>".format(self.group_by.capitalize())]
+        for group, (sessions, fees) in billing_totals(self.rows, self.group_by).items():
+            lines.append("<tr><td>{}</td><td align='center'>{}</td><td align='right'>{}</td></tr>".format(group, sessions, fees))
+        lines.append("</table>")
+        self.totals.setText("".join(lines))
+
+class DisplayQueryByClientWidget(DisplayQueryByRangeWidget):
+    """A scene to display every session of one client over a range of days."""
+
+    def __init__(self, name=None, events=None, data=None, parent=None):
+        super().__init__(name, events, group_by="client", parent=parent)
+
+class DisplayQueryByPracticeWidget(DisplayQueryByRangeWidget):
+    """A scene to display one report for every clinician in the practice,
+       with a column for whose calendar each session is from."""
+
+    HEADER = PRACTICE_BILLING_HEADER
+
+    def make_rows(self, tagged_events):
+        """One BillingRow per (clinician, event)"""
+        return [BillingRow(event, clinician) for clinician, event in tagged_events]
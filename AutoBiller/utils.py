@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 
-import csv, os, json, sys
+import csv, hashlib, os, json, sys
+from functools import lru_cache
 
 # Set path to relative if running from within the bundle
 def abs_path(relative_path):
     if getattr(sys, 'frozen', False): 
         return os.path.join(os.path.dirname(sys.executable), relative_path)
     else:
-        return relative_path
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), relative_path)
 
 def get_download_path():
     """Returns the default downloads path for linux or windows"""
@@ -21,20 +22,62 @@ def get_download_path():
     else:
         return os.path.join(os.path.expanduser('~'), 'downloads')
 
+def get_data_path():
+    """Returns the folder where the AutoBiller keeps its local data, creating it if needed"""
+    path = os.path.join(os.path.expanduser('~'), '.autobiller')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def get_account_path(username, kind, extension):
+    """Returns the path of a local data file belonging to one iCloud account.
+       The username is hashed, so it doesn't appear in the file name."""
+    digest = hashlib.sha1(username.lower().encode("utf-8")).hexdigest()[:16]
+    return os.path.join(get_data_path(), "{}-{}.{}".format(kind, digest, extension))
+
+def download_path(filename, extension):
+    """Returns the path a file with the given name will be saved to in Downloads"""
+    return os.path.join(get_download_path(), filename + "." + extension)
+
 def download_csv_file(filename, fieldnames, list_of_rows):
-    """Writes a csv file to the given filename"""
-    dir_name = get_download_path()
-    path = dir_name + "/" + filename + ".csv"
+    """Writes a csv file to the given filename in Downloads.
+       list_of_rows can be any iterable of dicts, and is written as it's read."""
+    return write_csv_file(download_path(filename, "csv"), fieldnames, list_of_rows)
 
-    with open(path, mode='w+') as csv_file:
+def write_csv_file(path, fieldnames, list_of_rows):
+    """Writes a csv file to the given path, streaming from list_of_rows"""
+    with open(path, mode='w+', newline='') as csv_file:
 
         writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
         writer.writeheader()
 
         for row in list_of_rows:
             writer.writerow(row)
+    return path
+
+def write_xlsx_file(path, fieldnames, list_of_rows):
+    """Writes an Excel workbook to the given path. Needs openpyxl.
+       The workbook is written in write-only mode, so rows are streamed to disk."""
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise RuntimeError("Exporting to .xlsx needs the openpyxl package (pip install openpyxl)")
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Billing Report")
+    sheet.append(fieldnames)
+    for row in list_of_rows:
+        sheet.append([row.get(field) for field in fieldnames])
+    workbook.save(path)
+    return path
+
+def write_text_file(path, lines):
+    """Writes an iterable of lines to a plain text file at the given path"""
+    with open(path, mode='w+') as text_file:
+        for line in lines:
+            text_file.write(line + "\n")
+    return path
 
-# fee_by_cpt_code = {
+# fees.json = {
 #     "90791": $$$, #Initial Session
 #     "96152": $$$, #15 min
 #     "90832": $$$, #30 min
@@ -45,9 +88,15 @@ def download_csv_file(filename, fieldnames, list_of_rows):
 #     "90839": $$$  #Crisis
 # }
 
-with open(abs_path("resources/fees.json"), "r") as f:
-    fee_by_cpt_code = json.load(f)
+@lru_cache(maxsize=None)
+def get_fees():
+    """The fee for each CPT code. fees.json is only read the first time
+       this is called, and the same dict is returned after that."""
+    with open(abs_path("resources/fees.json"), "r") as f:
+        return json.load(f)
 
 def write_fees(new_fees):
-    with open("resources/fees.json", "w+") as f:
+    """Save new fees to fees.json, and update the dict from get_fees() in place"""
+    with open(abs_path("resources/fees.json"), "w+") as f:
         json.dump(new_fees, f)
+    get_fees().update(new_fees)
@@ -13,12 +13,19 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/JYudelson1/AutoBiller",
     packages=setuptools.find_packages(),
+    # The resources listed in MANIFEST.in (icons, fees.json) are needed at runtime
+    include_package_data=True,
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.6',
+    # Saved iCloud sessions are always encrypted
+    install_requires=['cryptography'],
+    extras_require={
+        'xlsx': ['openpyxl'],
+    },
     entry_points={
         'console_scripts': [
             'AutoBiller = AutoBiller.__main__:main',
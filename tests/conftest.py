@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+
+import os, sys
+
+# The AutoBiller's modules import each other by name, as when run from its folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "AutoBiller"))
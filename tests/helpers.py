@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+
+from calendarBackends import SyntheticBackend
+from calendarLogic import *
+
+# Shared by the tests, so they don't depend on the benchmark script
+
+START = datetime(2021, 1, 4)
+
+def new_manager(backend=None):
+    """A CalendarManager over synthetic data, prefetching in the foreground so tests are repeatable"""
+    manager = CalendarManager(backend=backend or SyntheticBackend(events_per_day=8))
+    manager.prefetcher = Prefetcher(manager, background=False)
+    return manager
+
+def check_index(date_ranges):
+    """Make sure a DateRangeIndex is sorted, non-overlapping, and in date order inside"""
+    ranges = list(date_ranges)
+    for before, after in zip(ranges, ranges[1:]):
+        assert before.end + ONE_DAY < after.start, "date ranges overlap or touch: {}".format(ranges)
+    for dr in ranges:
+        columns = dr.columns
+        events, starts, titles = columns.events, columns.starts, columns.titles
+        # A DateRange is only ever replaced, never changed while it's in the index
+        assert len(events) == len(starts) == len(titles), "half-updated columns in {}".format(dr)
+        assert all(to_epoch(e.date) == start for e, start in zip(events, starts)), "columns disagree in {}".format(dr)
+        assert all(a.date <= b.date for a, b in zip(events, events[1:])), "events out of order in {}".format(dr)
+        assert all(dr.contains(e.day) for e in events), "event outside of {}".format(dr)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import random, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from datetime import datetime, timedelta
+
+from calendarLogic import *
+from calendarBackends import SyntheticBackend
+from instrumentation import Metrics
+
+from helpers import check_index, new_manager, START
+
+def test_concurrent_add_one_day():
+    """Hundreds of add_one_day calls from many threads, against a backend with
+       some latency, with readers checking every snapshot. Each day must come
+       back with exactly its own events, and no reader may see a half-merged index."""
+    manager = new_manager(SyntheticBackend(events_per_day=8, latency=0.002, jitter=0.002))
+    reference = SyntheticBackend(events_per_day=8)
+    rng = random.Random(5)
+    days = [START + timedelta(days=rng.randrange(120)) for _ in range(400)]
+    errors = []
+    stop = threading.Event()
+
+    def query(day):
+        expected = [event["guid"] for event in reference.events_on(day)]
+        got = [event.identity() for event in manager.add_one_day(day)]
+        if got != expected:
+            errors.append("{}: got {} events, expected {}".format(day, len(got), len(expected)))
+
+    def read():
+        while not stop.is_set():
+            try:
+                check_index(manager.date_ranges)
+            except Exception as error:
+                errors.append("{}: {}".format(type(error).__name__, error))
+            # Leave the writers some of the GIL
+            time.sleep(0.001)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    try:
+        with ThreadPoolExecutor(max_workers=32) as pool:
+            list(pool.map(query, days))
+    finally:
+        stop.set()
+        for reader in readers:
+            reader.join()
+
+    check_index(manager.date_ranges)
+    assert not errors, errors[:5]
+
+def test_check_index_catches_touching_ranges():
+    # The stress test's readers only notice a bad snapshot if this raises AssertionError
+    index = DateRangeIndex()
+    index.replace(0, 0, DateRange(START, START), DateRange(START + ONE_DAY, START + ONE_DAY))
+    with pytest.raises(AssertionError):
+        check_index(index)
+
+class ReschedulingBackend(SyntheticBackend):
+    """Bumping version also reschedules every event an hour later (on the same day)"""
+
+    def events_on(self, day):
+        events = []
+        for event in super(ReschedulingBackend, self).events_on(day):
+            start = datetime(*event["localStartDate"][1:6]) + timedelta(hours=self.version - 1)
+            events.append(event_dict(event["guid"], event["title"], start, event["duration"], event["etag"]))
+        return events
+
+def freeze(date_ranges):
+    return [(dr.start, dr.end, [(e, e.date, e.version()) for e in dr.get_events()], list(dr.columns.starts))
+            for dr in date_ranges]
+
+def test_published_snapshots_never_change():
+    """Readers don't take the lock, so a DateRangeIndex (and its DateRanges)
+       must never change once published: merges and syncs publish copies."""
+    backend = ReschedulingBackend(events_per_day=8)
+    manager = new_manager(backend)
+    manager.add_date_range(DateRange(START, START + timedelta(days=6)), record=False)
+    manager.add_date_range(DateRange(START + timedelta(days=10), START + timedelta(days=12)), record=False)
+    snapshot = manager.date_ranges
+    frozen = freeze(snapshot)
+
+    # Fill the gap, so both ranges are merged into one
+    manager.add_date_range(DateRange(START + timedelta(days=5), START + timedelta(days=11)), record=False)
+    # Edit and reschedule every event, and sync part of it
+    backend.version += 1
+    manager.sync_date_range(DateRange(START + timedelta(days=2), START + timedelta(days=4)))
+
+    assert len(manager.date_ranges) == 1
+    assert manager.date_ranges is not snapshot
+    assert freeze(snapshot) == frozen
+    check_index(snapshot)
+    check_index(manager.date_ranges)
+
+def test_no_sample_is_lost_while_folding(monkeypatch):
+    metrics = Metrics()
+    monkeypatch.setattr(Metrics, "FOLD_EVERY", 64)
+    per_thread = 50000
+    # Switch threads as often as possible, so appends land in the middle of folds
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+
+    def add():
+        for _ in range(per_thread):
+            metrics.add_sample("stage", 0.001)
+
+    threads = [threading.Thread(target=add) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            metrics.snapshot()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert metrics.snapshot()["timers"]["stage"]["count"] == 4 * per_thread
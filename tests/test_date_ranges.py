@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from calendarBackends import SyntheticBackend
+from calendarLogic import *
+
+from helpers import check_index, new_manager, START
+
+# Property tests: random operations, checked against a brute-force model
+# (a plain set of covered days). Each seed is one reproducible sequence.
+
+DAYS = 60
+SEEDS = range(25)
+
+def day(n):
+    return START + timedelta(days=n)
+
+def random_range(rng):
+    first = rng.randrange(DAYS)
+    return DateRange(day(first), day(min(DAYS - 1, first + rng.choice((0, 0, 1, 2, 5, 13)))))
+
+def day_numbers(date_range):
+    return set(range((date_range.start - START).days, (date_range.end - START).days + 1))
+
+def runs(numbers):
+    """Sorted lists of consecutive numbers, as (first, last) pairs"""
+    found = []
+    for n in sorted(numbers):
+        if found and found[-1][1] == n - 1:
+            found[-1][1] = n
+        else:
+            found.append([n, n])
+    return [tuple(run) for run in found]
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_index_matches_model(seed):
+    rng = random.Random(seed)
+    index = DateRangeIndex()
+    covered = set()
+    for _ in range(40):
+        date_range = random_range(rng)
+        index.cover(date_range)
+        covered |= day_numbers(date_range)
+
+        # Sorted, and no two ranges overlap or touch: exactly the runs of covered days
+        assert [((dr.start - START).days, (dr.end - START).days) for dr in index] == runs(covered)
+        assert index.starts == [dr.start for dr in index]
+
+        query = random_range(rng)
+        wanted = day_numbers(query)
+        assert [((gap.start - START).days, (gap.end - START).days) for gap in index.missing(query)] == runs(wanted - covered)
+        assert (index.covering(query) is not None) == (wanted <= covered)
+        n = rng.randrange(DAYS)
+        found = index.find(day(n))
+        assert (found is not None) == (n in covered)
+        if found is not None:
+            assert found.contains(day(n))
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_add_date_range_matches_backend(seed):
+    rng = random.Random(seed)
+    backend = SyntheticBackend(events_per_day=4, weekends=True, seed=seed)
+    manager = new_manager(backend)
+    # day number -> the calendar version it was last downloaded at
+    downloaded_at = {}
+    for _ in range(25):
+        date_range = random_range(rng)
+        if rng.random() < 0.2:
+            # The whole calendar is edited, and what's being asked for is synced
+            backend.version += 1
+            manager.sync_date_range(date_range)
+            for n in day_numbers(date_range):
+                downloaded_at[n] = backend.version
+        for n in day_numbers(date_range):
+            downloaded_at.setdefault(n, backend.version)
+        got = manager.add_date_range(DateRange(date_range.start, date_range.end), record=False)
+        covered = set(downloaded_at)
+
+        expected = [event for n in sorted(day_numbers(date_range)) for event in backend.events_on(day(n))]
+        assert [e.identity() for e in got] == [e["guid"] for e in expected]
+        assert [e.calendar_dict["etag"] for e in got] == [str(downloaded_at[e.day.toordinal() - START.toordinal()]) for e in got]
+
+        check_index(manager.date_ranges)
+        assert [((dr.start - START).days, (dr.end - START).days) for dr in manager.date_ranges] == runs(covered)
+        # Every cached event is there exactly once
+        cached = [e.identity() for dr in manager.date_ranges for e in dr.get_events()]
+        assert len(cached) == len(set(cached)) == len(covered) * backend.events_per_day
+
+def test_patch_events_touches_only_what_changed():
+    backend = SyntheticBackend(events_per_day=4)
+    manager = new_manager(backend)
+    week = DateRange(START, day(6))
+    before = {e.identity(): e for e in manager.add_date_range(week, record=False)}
+
+    fresh = list(parse_events(backend.fetch_events(week.start, week.end)))
+    moved = fresh.pop(0)
+    moved.calendar_dict = dict(moved.calendar_dict, etag="moved")
+    dr = manager.date_ranges[0].copy()
+    added, changed, removed = dr.patch_events(week, [moved] + fresh[1:])
+
+    assert added == [] and [e.identity() for e in changed] == [moved.identity()]
+    assert [e.identity() for e in removed] == [fresh[0].identity()]
+    # Unchanged events keep their objects
+    assert all(e is before[e.identity()] for e in dr.get_events() if e.identity() != moved.identity())
+
+class ReschedulingBackend(SyntheticBackend):
+    """A SyntheticBackend where some events have been moved to another day"""
+
+    def __init__(self, **kwargs):
+        super(ReschedulingBackend, self).__init__(**kwargs)
+        # guid -> the event dict it was moved to
+        self.moves = {}
+
+    def reschedule(self, event, start):
+        moved = event_dict(event["guid"], event["title"], start, event["duration"], "moved")
+        self.moves[event["guid"]] = moved
+
+    def events_between(self, start, end):
+        events = [e for e in super(ReschedulingBackend, self).events_between(start, end) if e["guid"] not in self.moves]
+        for moved in self.moves.values():
+            if start.date() <= datetime(*moved["localStartDate"][1:4]).date() <= end.date():
+                events.append(moved)
+        return events
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_sync_moves_rescheduled_event(cached):
+    backend = ReschedulingBackend(events_per_day=4, weekends=True)
+    manager = new_manager(backend)
+    manager.add_date_range(DateRange(day(14), day(20)), record=False)
+    if cached:
+        manager.add_date_range(DateRange(day(0), day(6)), record=False)
+    session = backend.events_on(day(16))[0]
+    backend.reschedule(session, day(1) + timedelta(hours=7))
+
+    # Only the day it was moved to is synced
+    added, changed, removed = manager.sync_date_range(DateRange(day(1), day(1)))
+
+    assert [e.identity() for e in changed] == [session["guid"]] and removed == []
+    assert session["guid"] not in [e.identity() for e in added]
+    cached_keys = [e.identity() for dr in manager.date_ranges for e in dr.get_events()]
+    assert cached_keys.count(session["guid"]) == 1
+    assert manager.events_within(DateRange(day(1), day(1)))[0].identity() == session["guid"]
+    assert session["guid"] not in [e.identity() for e in manager.events_within(DateRange(day(16), day(16)))]
+    check_index(manager.date_ranges)
+
+class FailingBackend(SyntheticBackend):
+    """A SyntheticBackend whose first failures requests raise errors[0], errors[1], ..."""
+
+    def __init__(self, *errors):
+        super(FailingBackend, self).__init__(events_per_day=4)
+        self.errors = list(errors)
+
+    def events_between(self, start, end):
+        if self.errors:
+            raise self.errors.pop(0)
+        return super(FailingBackend, self).events_between(start, end)
+
+def test_download_retries_transient_errors():
+    backend = FailingBackend(ConnectionError("reset"), TimeoutError("timed out"))
+    manager = new_manager(backend)
+    manager.RETRY_BACKOFF = 0
+    assert len(manager.add_date_range(DateRange(START, START), record=False)) == 4
+    assert backend.requests == 3
+
+def test_download_fails_fast_on_other_errors():
+    backend = FailingBackend(PermissionError("logged out"))
+    manager = new_manager(backend)
+    manager.RETRY_BACKOFF = 0
+    with pytest.raises(PermissionError):
+        manager.add_date_range(DateRange(START, START), record=False)
+    assert backend.requests == 1
+    assert backend.is_transient(ConnectionError()) and not backend.is_transient(KeyError())
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import json, os
+from datetime import timedelta
+
+from calendarBackends import SyntheticBackend
+from calendarLogic import parse_events
+from clientLogic import *
+
+from helpers import START
+
+def test_batch_saves_once(tmp_path, monkeypatch):
+    path = str(tmp_path / "decisions.json")
+    directory = ClientDirectory()
+    directory.use_decisions(DecisionCache(path))
+    client = directory.add_client("Jon Smith")
+    events = list(parse_events(SyntheticBackend(titles=["Jon Smith"]).fetch_events(START, START)))
+
+    saves = []
+    real_save = DecisionCache.save
+    monkeypatch.setattr(DecisionCache, "save", lambda self: (saves.append(1), real_save(self)))
+    with directory.batch_decisions():
+        for event in events:
+            client.change_event_billability(event, True)
+        assert saves == []
+    assert len(saves) == 1
+    assert not os.path.exists(path + ".tmp")
+    assert DecisionCache(path).lookup(events[0]) == ("Jon Smith", True)
+
+def test_corrupt_file_starts_over(tmp_path):
+    path = tmp_path / "decisions.json"
+    path.write_text('[["title:jon smith", ["Jon Sm')
+    assert DecisionCache(str(path)).decisions == {}
+
+def series(count):
+    """count events of one recurring session, on consecutive days"""
+    backend = SyntheticBackend(titles=["Jon Smith"], events_per_day=1, weekends=True, other_rate=0)
+    return list(parse_events(backend.fetch_events(START, START + timedelta(days=count - 1))))
+
+def test_no_only_applies_to_its_event(tmp_path):
+    directory = ClientDirectory()
+    directory.use_decisions(DecisionCache(str(tmp_path / "decisions.json")))
+    client = directory.add_client("Jon Smith")
+    cancelled, later = series(2)
+
+    client.add_unbillable_event(cancelled)
+    assert directory.is_event_billable(cancelled) is None
+    # The rest of the series is still matched, and still asked about
+    assert directory.is_event_billable(later)["client"] is client
+    assert DecisionCache(str(tmp_path / "decisions.json")).lookup(later) is None
+
+    # A yes does carry over to the rest of the series
+    client.add_billable_event(cancelled)
+    assert DecisionCache(str(tmp_path / "decisions.json")).lookup(later) == ("Jon Smith", True)
+
+def test_old_series_no_is_ignored(tmp_path):
+    path = tmp_path / "decisions.json"
+    path.write_text(json.dumps([["title:jon smith", ["Jon Smith", False]]]))
+    assert DecisionCache(str(path)).lookup(series(1)[0]) is None
+
+def test_forget_decisions(tmp_path):
+    path = str(tmp_path / "decisions.json")
+    directory = ClientDirectory()
+    directory.use_decisions(DecisionCache(path))
+    client = directory.add_client("Jon Smith")
+    event, = series(1)
+    client.add_unbillable_event(event)
+    assert directory.is_event_billable(event) is None
+
+    directory.forget_decisions()
+    assert directory.is_event_billable(event)["client"] is client
+    assert DecisionCache(path).decisions == {}
+
+def test_answer_reindexes_only_its_event(monkeypatch):
+    directory = ClientDirectory()
+    client = directory.add_client("Jon Smith")
+    event_index = ClientEventIndex(directory)
+    events = series(3)
+    event_index.add_events(events)
+    assert event_index.events_for(client) == events
+
+    rebuilds = []
+    monkeypatch.setattr(ClientEventIndex, "rebuild_if_stale",
+                        lambda self: rebuilds.append(1) if self.version != self.directory.version else None)
+    client.add_unbillable_event(events[1])
+    assert event_index.events_for(client) == [events[0], events[2]]
+    assert rebuilds == []
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from calendarBackends import event_dict
+from calendarLogic import CalendarEvent
+from clientLogic import *
+from utils import get_fees
+
+from helpers import START
+
+def directory_of(*names):
+    directory = ClientDirectory()
+    for name in names:
+        directory.add_client(name, "Aetna")
+    return directory
+
+def event(title, duration=50):
+    return CalendarEvent(event_dict("guid-" + title, title, START, duration))
+
+@pytest.mark.parametrize("minutes, cpt", [
+    (0, "96152"), (15, "96152"), (16, "90832"), (37, "90832"),
+    (38, "90834"), (52, "90834"), (53, "90837"), (90, "90837"),
+])
+def test_cpt_for_duration(minutes, cpt):
+    assert cpt_for_duration(minutes) == cpt
+
+def test_exact_match_needs_every_token():
+    directory = directory_of("Jon Smith", "Ann Lee")
+    jon = directory.clients_by_name["Jon Smith"]
+    assert directory.exact_match("Session - smith, JON (f/u)") == (jon, "Jon Smith")
+    assert directory.exact_match("Jon Smithers") is None
+    assert directory.exact_match("Lunch") is None
+
+def test_exact_match_prefers_longer_names():
+    directory = directory_of("Jon Smith", "Jon Smith Jr")
+    assert directory.exact_match("Jon Smith Jr session")[1] == "Jon Smith Jr"
+    assert directory.exact_match("Jon Smith session")[1] == "Jon Smith"
+
+def test_fuzzy_match_forgives_typos_and_order():
+    directory = directory_of("Jon Smith", "Ann Lee")
+    jon = directory.clients_by_name["Jon Smith"]
+    for title in ("Jon Smtih", "Smith Jon", "jsmith f/u"):
+        client, b_name, confidence = directory.fuzzy_match(title)
+        assert (client, b_name) == (jon, "Jon Smith")
+        assert confidence > directory.FUZZY_THRESHOLD
+    assert directory.fuzzy_match("Team meeting") is None
+
+def test_billable_names_match_their_client():
+    directory = directory_of("Jonathan Smith")
+    client = directory.clients_by_name["Jonathan Smith"]
+    client.add_billable_name("Jon S")
+    assert directory.match_client("Jon S") == (client, "Jon S", 1.0)
+
+def test_is_event_billable_dict():
+    directory = directory_of("Jon Smith")
+    client = directory.clients_by_name["Jon Smith"]
+    session_data = directory.is_event_billable(event("Jon Smith", 45))
+    assert session_data == {
+        "client": client,
+        "name": "Jon Smith",
+        "cpt": "90834",
+        "insurance": "Aetna",
+        "fee": str(get_fees()["90834"]),
+        "confidence": 1.0,
+    }
+    assert not directory.needs_confirmation(session_data)
+
+def test_is_event_billable_low_confidence_and_answers():
+    directory = directory_of("Jon Smith")
+    client = directory.clients_by_name["Jon Smith"]
+    misspelled = event("Jno Smith")
+    session_data = directory.is_event_billable(misspelled)
+    assert session_data["client"] is client and directory.needs_confirmation(session_data)
+
+    client.add_billable_event(misspelled)
+    assert directory.is_event_billable(misspelled)["confidence"] == 1.0
+    client.add_unbillable_event(misspelled)
+    assert directory.is_event_billable(misspelled) is None
+    assert directory.is_event_billable(event("Lunch")) is None